@@ -6,6 +6,7 @@ from flask_moment import Moment
 from flask_pagedown import PageDown
 from flask_sqlalchemy import SQLAlchemy
 from config import configdic
+from .cache import ResponseCache
 
 
 bootstrap = Bootstrap()
@@ -16,6 +17,7 @@ login_manager.login_message = '请登陆后访问'
 mail = Mail()
 moment = Moment()
 pagedown = PageDown()
+response_cache = ResponseCache()
 
 # 创建Flask应用
 def create_app(config_name):
@@ -30,6 +32,11 @@ def create_app(config_name):
     mail.init_app(app)
     moment.init_app(app)
     pagedown.init_app(app)
+    response_cache.init_app(app)
+
+    # 请求体过大时直接返回413，须在蓝本的before_app_request之前注册
+    from .main.errors import reject_large_request
+    app.before_request(reject_large_request)
 
     # 添加路由
     from .main import main as main_blueprint
@@ -37,5 +44,24 @@ def create_app(config_name):
     from .auth import auth as auth_blueprint
     app.register_blueprint(auth_blueprint)
 
+    # 以内容hash命名的头像设置长期缓存
+    from .image import immutable_avatar_headers
+    app.after_request(immutable_avatar_headers)
+
+    # 第一个请求到来时启动后台写入线程（阅读记录、上次登陆时间）
+    if app.config['BUFFER_FLUSH_INTERVAL']:
+        from .buffer import start_flusher
+
+        @app.before_first_request
+        def start_buffer_flusher():
+            start_flusher(app)
+
+    # 第一个请求到来时启动发送邮件的后台线程
+    if app.config['MAIL_QUEUE_WORKERS']:
+        from .email import mail_queue
+
+        @app.before_first_request
+        def start_mail_workers():
+            mail_queue.start_workers(app)
 
     return app
\ No newline at end of file
@@ -6,17 +6,19 @@ from . import auth
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm, \
     ResetPasswordRequestForm, ResetPasswordForm, ChangeEmailRequestForm, \
     EditProfileForm    
-from .. import db
+from .. import db, response_cache
 from ..models import User
+from ..buffer import last_login_buffer
 from ..email import send_email
-from ..image import create_avatar
+from ..image import save_avatar, AvatarError
 
 
 @auth.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        # 更新用户上次登陆时间
-        current_user.update_last_login()
+        # 更新用户上次登陆时间（静态文件请求不更新）
+        if request.endpoint != 'static':
+            current_user.update_last_login()
         # 如果用户还未确认注册信息，则跳转到未确认注册界面
         if not current_user.confirmed \
                 and request.blueprint != 'auth' \
@@ -24,6 +26,13 @@ def before_request():
             return redirect(url_for('auth.unconfirmed'))
 
 
+# 定期把缓冲的上次登陆时间批量写入数据库
+@auth.after_app_request
+def after_request(response):
+    last_login_buffer.flush_if_due()
+    return response
+
+
 # 登陆
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
@@ -193,12 +202,15 @@ def edit_profile():
         # 提交用户头像
         avatar = request.files['avatar']
         if avatar:
-            if not create_avatar(avatar):
-                flash('文件类型错误')
+            try:
+                save_avatar(current_user, avatar)
+            except AvatarError as e:
+                flash(str(e))
                 return redirect(url_for('main.user', username=current_user.username))
         db.session.add(current_user)
         db.session.commit()
-        flash('您的个人资料已更新，如头像未更新，请刷新浏览器以显示新的头像')
+        response_cache.clear()
+        flash('您的个人资料已更新，新头像处理完成后即会显示')
         return redirect(url_for('main.user', username=current_user.username))
     form.avatar.data = os.path.join(current_app.config['AVATAR_DEST'], current_user.b_avatar)
     form.name.data = current_user.name
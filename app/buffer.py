@@ -0,0 +1,161 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+from .cache import invalidate_users
+from .sql import insert_ignore
+
+
+# 上次登陆时间写缓冲区
+# 请求中只在内存里记录用户最新的登陆时间，
+# 每隔LAST_LOGIN_FLUSH_INTERVAL秒用一条UPDATE语句批量写入数据库
+class LastLoginBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 待写入的登陆时间 {用户id: 登陆时间}
+        self._pending = {}
+        self._last_flush = datetime.utcnow()
+
+    # 记录用户的登陆时间
+    # 距离上次记录不足LAST_LOGIN_INTERVAL秒时直接忽略
+    def touch(self, user):
+        now = datetime.utcnow()
+        window = timedelta(seconds=current_app.config['LAST_LOGIN_INTERVAL'])
+        with self._lock:
+            last = self._pending.get(user.id) or user.last_login
+            if last is not None and now - last < window:
+                return False
+            self._pending[user.id] = now
+        return True
+
+    # 把缓冲的登陆时间写入数据库，返回写入的用户数
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = datetime.utcnow()
+        if not pending:
+            return 0
+        users = db.metadata.tables['users']
+        # UPDATE users SET last_login = CASE id WHEN ... END WHERE id IN (...)
+        stmt = users.update()\
+            .where(users.c.id.in_(pending))\
+            .values(last_login=db.case(pending, value=users.c.id))
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt)
+        except SQLAlchemyError:
+            current_app.logger.exception('写入上次登陆时间失败')
+            # 写入失败时放回缓冲区，等待下次写入（不覆盖更新的记录）
+            with self._lock:
+                for user_id, last_login in pending.items():
+                    self._pending.setdefault(user_id, last_login)
+            return 0
+        # 数据库中的登陆时间已改变，清除这些用户的缓存
+        invalidate_users(pending)
+        return len(pending)
+
+    # 距离上次写入超过LAST_LOGIN_FLUSH_INTERVAL秒时写入数据库
+    def flush_if_due(self):
+        interval = timedelta(
+            seconds=current_app.config['LAST_LOGIN_FLUSH_INTERVAL'])
+        if datetime.utcnow() - self._last_flush >= interval:
+            return self.flush()
+        return 0
+
+
+# 文章阅读记录写缓冲区
+# 请求中只在内存里记录(文章id, 阅读者id)并去重，
+# 由后台线程批量写入：多行INSERT IGNORE写入阅读记录（依靠唯一索引去掉已有记录），
+# 再用一条UPDATE重新统计相关文章的阅读数
+class ViewBuffer:
+    # 每条INSERT语句最多写入的阅读记录数
+    chunk_size = 500
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 待写入的阅读记录 {(文章id, 阅读者id)}
+        self._pending = set()
+        self._last_flush = time.time()
+
+    # 记录一次阅读
+    def add(self, post_id, viewer_id):
+        with self._lock:
+            self._pending.add((post_id, viewer_id))
+
+    # 把缓冲的阅读记录写入数据库，返回新增的阅读记录数
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            self._last_flush = time.time()
+        if not pending:
+            return 0
+        try:
+            return self._write(pending)
+        except SQLAlchemyError:
+            current_app.logger.exception('写入阅读记录失败')
+            with self._lock:
+                self._pending |= pending
+            return 0
+
+    # 有待写入的记录，并且距离上次写入超过BUFFER_FLUSH_INTERVAL秒
+    # 没有启动后台线程（间隔为0）时只要有待写入的记录就到期
+    def is_due(self):
+        return bool(self._pending) and time.time() - self._last_flush >= \
+            current_app.config['BUFFER_FLUSH_INTERVAL']
+
+    def _write(self, pending):
+        views = db.metadata.tables['views']
+        posts = db.metadata.tables['posts']
+        pending = sorted(pending)
+        count = 0
+        with db.engine.begin() as conn:
+            # 多行INSERT IGNORE写入阅读记录，已有的记录被唯一索引忽略
+            for i in range(0, len(pending), self.chunk_size):
+                count += conn.execute(insert_ignore(views).values([
+                    {'post_id': post_id, 'viewer_id': viewer_id}
+                    for post_id, viewer_id in pending[i:i + self.chunk_size]
+                ])).rowcount
+            if not count:
+                return count
+            # 重新统计相关文章的阅读数
+            post_ids = {post_id for post_id, viewer_id in pending}
+            conn.execute(
+                posts.update()
+                .where(posts.c.id.in_(post_ids))
+                .values(views_count=db.select([db.func.count(views.c.id)])
+                        .where(views.c.post_id == posts.c.id).as_scalar()))
+        return count
+
+
+last_login_buffer = LastLoginBuffer()
+view_buffer = ViewBuffer()
+
+
+# 把所有缓冲区的内容写入数据库，返回(新增的阅读记录数, 写入登陆时间的用户数)
+def flush_buffers():
+    return view_buffer.flush(), last_login_buffer.flush()
+
+
+# 启动后台写入线程，每隔BUFFER_FLUSH_INTERVAL秒写入一次
+# 进程退出时再写入一次，尽量不丢失缓冲的记录
+def start_flusher(app):
+    interval = app.config['BUFFER_FLUSH_INTERVAL']
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                view_buffer.flush()
+                last_login_buffer.flush_if_due()
+
+    def flush_at_exit():
+        with app.app_context():
+            flush_buffers()
+
+    thr = threading.Thread(target=run, name='buffer-flusher', daemon=True)
+    thr.start()
+    atexit.register(flush_at_exit)
+    return thr
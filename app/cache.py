@@ -0,0 +1,210 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+from .conditional import is_not_modified
+
+
+# 进程内LRU缓存，每条记录有过期时间，超过maxsize时淘汰最久未使用的记录
+# 多进程部署时清除缓存只作用于当前进程，其他进程的缓存靠过期时间更新
+class SimpleCache:
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._cache[key] = (time.time() + timeout, value)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# 登陆用户缓存 {用户id: 用户表各列的值}，每个应用一份，保存在app.extensions中
+# 只缓存列的值，不缓存ORM对象，取出后由load_user重新组装成用户对象
+def user_cache():
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault(
+            'user_cache', SimpleCache(current_app.config['USER_CACHE_SIZE']))
+    return cache
+
+
+# 清除指定用户的缓存
+def invalidate_users(user_ids):
+    cache = current_app.extensions.get('user_cache')
+    if cache is not None:
+        for user_id in user_ids:
+            cache.delete(user_id)
+
+
+# 文件系统缓存，同一台服务器上的多个进程共享
+class FileSystemCache:
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, timeout):
+        # 先写临时文件再替换，其他进程不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + timeout, value), f)
+        os.replace(tmp, self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+# Redis缓存（需要安装redis），多台服务器共享
+# 所有键都带有版本号前缀，清除缓存时只需把版本号+1，旧的键等待过期
+class RedisCache:
+    def __init__(self, url, prefix='beeblog:page:'):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key):
+        version = self._redis.get(self.prefix + 'version') or b'0'
+        return '{}{}:{}'.format(self.prefix, version.decode(), key)
+
+    def get(self, key):
+        value = self._redis.get(self._key(key))
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, timeout):
+        self._redis.setex(self._key(key), int(timeout), pickle.dumps(value))
+
+    def clear(self):
+        self._redis.incr(self.prefix + 'version')
+
+
+# 匿名用户页面缓存
+# 匿名用户看到的页面都相同，缓存GET请求的响应，命中时不再查询数据库和渲染模板
+class ResponseCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_type = app.config['RESPONSE_CACHE_TYPE']
+        if cache_type == 'simple':
+            backend = SimpleCache(app.config['RESPONSE_CACHE_SIZE'])
+        elif cache_type == 'filesystem':
+            backend = FileSystemCache(app.config['RESPONSE_CACHE_DIR'])
+        elif cache_type == 'redis':
+            backend = RedisCache(app.config['RESPONSE_CACHE_REDIS_URL'])
+        else:
+            backend = None
+        app.extensions['response_cache'] = {
+            'backend': backend, 'hits': 0, 'misses': 0,
+            'lock': threading.Lock()}
+
+    @property
+    def _state(self):
+        return current_app.extensions['response_cache']
+
+    # 命中、未命中计数（多个请求线程同时更新，需要加锁）
+    @staticmethod
+    def _count(state, key):
+        with state['lock']:
+            state[key] += 1
+
+    # 当前请求能否使用缓存：匿名用户的GET请求，并且没有待显示的flash消息
+    @staticmethod
+    def _cacheable():
+        return request.method == 'GET' and current_user.is_anonymous \
+            and not session.get('_flashes')
+
+    # 视图装饰器，缓存匿名用户的页面
+    def cached(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            state = self._state
+            backend = state['backend']
+            if backend is None or not self._cacheable():
+                return f(*args, **kwargs)
+            key = 'view:' + request.full_path
+            cached = backend.get(key)
+            if cached is not None:
+                self._count(state, 'hits')
+                data, status, headers = cached
+                response = current_app.response_class(
+                    data, status=status, headers=headers)
+                # 缓存的页面有ETag时，客户端缓存仍有效则返回304
+                etag, _ = response.get_etag()
+                if etag and is_not_modified(etag):
+                    response = current_app.response_class(
+                        status=304, headers=headers)
+                    response.headers.pop('Content-Length', None)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            self._count(state, 'misses')
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                headers = [(k, v) for k, v in response.headers.items()
+                           if k.lower() != 'set-cookie']
+                backend.set(key, (response.get_data(), response.status_code,
+                                  headers),
+                            current_app.config['RESPONSE_CACHE_TIMEOUT'])
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated_function
+
+    # 清除缓存（文章、评论、点赞、关注、个人资料有变化时调用）
+    def clear(self):
+        backend = self._state['backend']
+        if backend is not None:
+            backend.clear()
+
+    # 缓存命中次数和未命中次数
+    def stats(self):
+        state = self._state
+        with state['lock']:
+            return {'type': current_app.config['RESPONSE_CACHE_TYPE'],
+                    'hits': state['hits'], 'misses': state['misses']}
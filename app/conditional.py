@@ -0,0 +1,44 @@
+import hashlib
+import time
+from flask import current_app, request, session
+from flask_login import current_user
+
+
+# 由页面的版本数据生成强ETag
+# 页面内容与当前用户有关（导航栏、按钮），所以ETag中包含用户的id、用户名和角色
+# csrf: 页面中有表单时为True，表单的CSRF令牌会过期，ETag每隔有效期的一半更换一次
+def make_etag(*parts, csrf=False):
+    if current_user.is_authenticated:
+        viewer = (current_user.id, current_user.username, current_user.role_id)
+    else:
+        viewer = None
+    if csrf:
+        limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        parts += (int(time.time() // (limit // 2)),)
+    data = repr((viewer,) + parts).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+# 客户端的缓存是否仍然有效（比较If-None-Match和ETag）
+# 有待显示的flash消息时页面与缓存不同，总是返回完整页面
+def is_not_modified(etag):
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        return False
+    return request.if_none_match.contains(etag)
+
+
+# 给响应设置ETag，并要求浏览器每次使用缓存前先验证
+def add_validators(response, etag):
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    return response
+
+
+# 客户端缓存仍有效时返回304响应，否则返回None
+def not_modified_response(etag):
+    if not is_not_modified(etag):
+        return None
+    response = current_app.response_class(status=304)
+    return add_validators(response, etag)
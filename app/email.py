@@ -1,22 +1,313 @@
-from threading import Thread
+import re
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail
+from markupsafe import escape
+from sqlalchemy.exc import SQLAlchemyError
+from . import db, mail
+from .models import MailJob
 
 
-# 发送电子邮件线程任务
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# 是否为连接层面的错误（连接断开、网络错误），而不是服务器拒收了某一封邮件
+# smtplib的异常都是OSError的子类，其中只有SMTPServerDisconnected表示连接已不可用
+def _is_connection_error(e):
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
 
 
-# 发送电子邮件多线程模式
+# 数据库邮件队列
+# send_email只把邮件写入mail_queue表，由固定数量的后台线程取出发送：
+# 每个线程每次领取一批邮件，用同一个SMTP连接连续发送，直到队列为空；
+# 发送失败的邮件按指数退避推迟重试，超过最大次数后标记为失败
+class MailQueue:
+    def __init__(self):
+        # 有新邮件时唤醒等待中的线程
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        # 本进程的发送统计
+        self._counts = {'sent': 0, 'retried': 0, 'abandoned': 0}
+
+    # 把邮件加入队列
+    # 使用单独的连接和事务写入，不影响请求中的数据库会话
+    def put(self, msg):
+        with db.engine.begin() as conn:
+            conn.execute(MailJob.__table__.insert().values(
+                sender=msg.sender, recipients=','.join(msg.recipients),
+                subject=msg.subject, body=msg.body, html=msg.html))
+        self._wakeup.set()
+
+    # 领取一批到期的邮件
+    # 先选出候选邮件，再用带条件的UPDATE打上本批的领取标记，
+    # 多个线程、进程同时领取时每封邮件只会被一方领到
+    def _claim(self, batch_size):
+        jobs = MailJob.__table__
+        now = datetime.utcnow()
+        due = db.and_(jobs.c.status == 'pending', jobs.c.next_attempt <= now)
+        token = uuid.uuid4().hex
+        lock = now + timedelta(
+            seconds=current_app.config['MAIL_QUEUE_LOCK_TIMEOUT'])
+        with db.engine.begin() as conn:
+            ids = [row.id for row in conn.execute(
+                db.select([jobs.c.id]).where(due)
+                .order_by(jobs.c.next_attempt, jobs.c.id).limit(batch_size))]
+            if not ids:
+                return []
+            conn.execute(jobs.update().where(db.and_(jobs.c.id.in_(ids), due))
+                         .values(claim=token, next_attempt=lock))
+            return conn.execute(jobs.select().where(jobs.c.claim == token)
+                                .order_by(jobs.c.id)).fetchall()
+
+    # 删除已发送的邮件
+    def _finish(self, ids):
+        if not ids:
+            return
+        jobs = MailJob.__table__
+        with db.engine.begin() as conn:
+            conn.execute(jobs.delete().where(jobs.c.id.in_(ids)))
+        self._count('sent', len(ids))
+
+    # 发送失败的邮件推迟重试：第n次失败后等待MAIL_QUEUE_RETRY_DELAY * 2^(n-1)秒，
+    # 达到MAIL_QUEUE_MAX_ATTEMPTS次后标记为failed，不再发送
+    def _retry(self, rows, error):
+        if not rows:
+            return
+        config = current_app.config
+        now = datetime.utcnow()
+        params = []
+        for row in rows:
+            attempts = row.attempts + 1
+            failed = attempts >= config['MAIL_QUEUE_MAX_ATTEMPTS']
+            params.append({
+                '_id': row.id, 'attempts': attempts,
+                'status': 'failed' if failed else 'pending',
+                'next_attempt': now + timedelta(
+                    seconds=config['MAIL_QUEUE_RETRY_DELAY'] * 2 ** (attempts - 1)),
+                'last_error': str(error)})
+            self._count('abandoned' if failed else 'retried')
+        jobs = MailJob.__table__
+        with db.engine.begin() as conn:
+            conn.execute(jobs.update().where(jobs.c.id == db.bindparam('_id'))
+                         .values(claim=None), params)
+
+    # 连接中断时把尚未发送的邮件放回队列，不计入尝试次数
+    def _release(self, rows):
+        if not rows:
+            return
+        jobs = MailJob.__table__
+        with db.engine.begin() as conn:
+            conn.execute(jobs.update().where(jobs.c.id.in_([row.id for row in rows]))
+                         .values(claim=None, next_attempt=datetime.utcnow()))
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+
+    # 把队列中的邮件组装成Message
+    @staticmethod
+    def _message(row):
+        return Message(row.subject, sender=row.sender,
+                       recipients=row.recipients.split(','),
+                       body=row.body, html=row.html)
+
+    # 发送队列中到期的邮件，返回发送成功的邮件数
+    # 一个SMTP连接连续发送多批邮件，直到队列为空；队列为空时不连接SMTP服务器
+    # 单封邮件被拒收或无法组装时只推迟这一封并计入尝试次数，反复出错的邮件最终被标记为失败；
+    # 连接出错时本批中尚未发送的邮件放回队列，不计入尝试次数
+    def process(self, batch_size=None):
+        batch_size = batch_size or current_app.config['MAIL_QUEUE_BATCH_SIZE']
+        rows = self._claim(batch_size)
+        if not rows:
+            return 0
+        sent = 0
+        done = []
+        skipped = set()
+        try:
+            with mail.connect() as conn:
+                while rows:
+                    for row in rows:
+                        try:
+                            conn.send(self._message(row))
+                        except Exception as e:
+                            if _is_connection_error(e):
+                                raise
+                            current_app.logger.warning('发送邮件%s失败：%s',
+                                                       row.id, e)
+                            self._retry([row], e)
+                            skipped.add(row.id)
+                            continue
+                        done.append(row.id)
+                    self._finish(done)
+                    sent += len(done)
+                    done = []
+                    skipped = set()
+                    rows = self._claim(batch_size)
+        except Exception as e:
+            if isinstance(e, OSError):
+                current_app.logger.warning('发送邮件失败：%s', e)
+            else:
+                current_app.logger.exception('发送邮件失败')
+            self._finish(done)
+            sent += len(done)
+            self._release([row for row in rows
+                           if row.id not in done and row.id not in skipped])
+        return sent
+
+    # 队列状态：待发送数、已到期数、失败数、最早待发送邮件的等待时间（秒），以及本进程的发送统计
+    def stats(self):
+        jobs = MailJob.__table__
+        now = datetime.utcnow()
+        with db.engine.connect() as conn:
+            counts = dict(conn.execute(
+                db.select([jobs.c.status, db.func.count()])
+                .group_by(jobs.c.status)).fetchall())
+            due = conn.execute(db.select([db.func.count()]).where(db.and_(
+                jobs.c.status == 'pending',
+                jobs.c.next_attempt <= now))).scalar()
+            oldest = conn.execute(db.select([db.func.min(jobs.c.created)])
+                                  .where(jobs.c.status == 'pending')).scalar()
+        with self._lock:
+            result = dict(self._counts)
+        result.update({
+            'pending': counts.get('pending', 0), 'due': due,
+            'failed': counts.get('failed', 0),
+            'oldest_pending_seconds':
+                (now - oldest).total_seconds() if oldest else 0})
+        return result
+
+    # 启动MAIL_QUEUE_WORKERS个后台发送线程
+    def start_workers(self, app):
+        def run():
+            while True:
+                with app.app_context():
+                    try:
+                        sent = self.process()
+                    except SQLAlchemyError:
+                        app.logger.exception('读取邮件队列失败')
+                        sent = 0
+                # 队列为空时等待新邮件或等待下次检查
+                if not sent:
+                    self._wakeup.wait(app.config['MAIL_QUEUE_POLL_INTERVAL'])
+                    self._wakeup.clear()
+
+        threads = [threading.Thread(target=run, name='mail-worker-{}'.format(i),
+                                    daemon=True)
+                   for i in range(app.config['MAIL_QUEUE_WORKERS'])]
+        for thr in threads:
+            thr.start()
+        return threads
+
+
+mail_queue = MailQueue()
+
+
+# 发送电子邮件：渲染后加入邮件队列，由后台线程发送
 def send_email(to, subject, template, **kwargs):
     app = current_app._get_current_object()
     msg = Message(app.config['MAIL_SUBJECT_PREFIX'] +' ' + subject,
                   sender=app.config['MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
\ No newline at end of file
+    mail_queue.put(msg)
+
+
+# 批量邮件中因收件人而异的字段的占位符
+# 模板只渲染一次，渲染结果中的占位符再替换为每个收件人的值；
+# 占位符支持属性访问（如user.username），但不能用于条件判断和过滤器
+class Placeholder:
+    def __init__(self, path):
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return Placeholder(self._path + '.' + name)
+
+    # 在html模板中原样输出，替换时再转义
+    def __html__(self):
+        return '\x1a{}\x1a'.format(self._path)
+
+    __str__ = __html__
+
+
+_placeholder_re = re.compile(r'\x1a([\w.]+)\x1a')
+
+
+# 按占位符的路径从收件人的字段中取值
+def _resolve(ctx, path):
+    name, *attrs = path.split('.')
+    value = ctx[name]
+    for attr in attrs:
+        value = getattr(value, attr)
+    return '' if value is None else str(value)
+
+
+# 把渲染好的模板中的占位符替换为收件人的值，html正文中的值需转义
+def _fill(rendered, ctx, html=False):
+    if html:
+        return _placeholder_re.sub(
+            lambda m: str(escape(_resolve(ctx, m.group(1)))), rendered)
+    return _placeholder_re.sub(lambda m: _resolve(ctx, m.group(1)), rendered)
+
+
+# 批量发送中途出错（连接断开、服务器拒绝发送）
+# sent为已发送的邮件数，recipient为出错的收件人，remaining为出错的收件人及其后尚未发送的收件人，
+# 可以用remaining重新调用send_bulk_email继续发送
+class BulkEmailError(Exception):
+    def __init__(self, sent, recipient, remaining, error):
+        super(BulkEmailError, self).__init__(
+            '已发送{}封邮件，发送给{}时出错：{}'.format(sent, recipient, error))
+        self.sent = sent
+        self.recipient = recipient
+        self.remaining = remaining
+        self.error = error
+
+
+# 批量发送电子邮件（公告、摘要）
+# recipients: 收件人地址列表
+# per_recipient_ctx: 每个收件人不同的模板变量，{地址: 变量字典}或参数为地址、返回变量字典的函数，
+# 所有收件人的变量名必须相同（开始发送前检查，不同时抛出ValueError）
+# kwargs: 所有收件人相同的模板变量
+# 两个模板各渲染一次，每个收件人只替换占位符，所有邮件通过同一个SMTP连接发送；
+# 被服务器拒收的收件人记入日志后跳过，返回发送成功的邮件数；
+# 其他发送错误抛出BulkEmailError，其中记录了已发送的邮件数和尚未发送的收件人
+def send_bulk_email(recipients, subject, template, per_recipient_ctx,
+                    **kwargs):
+    if not recipients:
+        return 0
+    app = current_app._get_current_object()
+    if not callable(per_recipient_ctx):
+        per_recipient_ctx = per_recipient_ctx.__getitem__
+    contexts = [per_recipient_ctx(to) for to in recipients]
+    fields = set(contexts[0])
+    for to, ctx in zip(recipients, contexts):
+        if set(ctx) != fields:
+            raise ValueError('收件人{}的模板变量{}与其他收件人{}不同'.format(
+                to, sorted(ctx), sorted(fields)))
+    kwargs.update({name: Placeholder(name) for name in fields})
+    body = render_template(template + '.txt', **kwargs)
+    html = render_template(template + '.html', **kwargs)
+    subject = app.config['MAIL_SUBJECT_PREFIX'] + ' ' + subject
+    sent = 0
+    i = 0
+    try:
+        with mail.connect() as conn:
+            for i, (to, ctx) in enumerate(zip(recipients, contexts)):
+                msg = Message(subject, sender=app.config['MAIL_SENDER'],
+                              recipients=[to], body=_fill(body, ctx),
+                              html=_fill(html, ctx, html=True))
+                try:
+                    conn.send(msg)
+                except smtplib.SMTPRecipientsRefused:
+                    app.logger.warning('收件人%s被拒收', to)
+                    continue
+                sent += 1
+    except (smtplib.SMTPException, OSError) as e:
+        error = BulkEmailError(sent, recipients[i], recipients[i:], e)
+        app.logger.warning('批量发送邮件中断：%s，还有%s个收件人未发送',
+                           error, len(error.remaining))
+        raise error from e
+    return sent
@@ -1,44 +1,357 @@
+import base64
+import glob
+import hashlib
 import os
-from flask import current_app
-from flask_login import current_user
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import current_app, request, url_for
 from PIL import Image
-from . import db
-from .models import User
-
-# 生成头像，成功返回True, 失败返回False
-def create_avatar(avatar):
-    fname = avatar.filename
-    flag = '.' in fname and \
-        fname.rsplit('.', 1)[1] in current_app.config['ALLOWED_EXTENSIONS']
-    if not flag:
-        return False
-    # 打开要缩放的头像（转换成RGB便于保存头像时把png等格式统一转化为jpg）
-    im = Image.open(avatar).convert('RGB')
-    # 头像的宽和高
-    w, h =im.size
-    # 短边长度的一半，用于定位
-    half = (w // 2) if (w <= h) else (h // 2)
-    # 裁剪头像的左、右、上、下坐标
-    left = w // 2 - half
-    right = w // 2 + half
-    top = h // 2 - half    
-    bottom =  h // 2  + half
-    # 裁剪成正方形的头像
-    cr_im = im.crop((left, top, right, bottom))
-    # 缩放后的大头像
-    b_im = cr_im.resize((128, 128))
-    # 缩放后的小头像
-    s_im = cr_im.resize((50, 50))  
-    # 大头像的文件名
-    b_flname = current_user.username + '/big.jpg'
-    # 小头像的文件名
-    s_flname = current_user.username + '/small.jpg'
-    if not os.path.isdir(os.path.join(current_app.config['AVATAR_DEST'], current_user.username)):
-        os.mkdir(os.path.join(current_app.config['AVATAR_DEST'], current_user.username))
-    # 保存大头像到指定路径
-    b_im.save(os.path.join(current_app.config['AVATAR_DEST'], b_flname))
-    # 保存小头像到指定路径
-    s_im.save(os.path.join(current_app.config['AVATAR_DEST'], s_flname))
-    current_user.b_avatar = b_flname
-    current_user.s_avatar = s_flname
-    return True
\ No newline at end of file
+from . import db, response_cache
+from .models import User, forget_users
+
+
+# 头像处理线程池，第一次上传时创建
+_executor = None
+_executor_lock = threading.Lock()
+# 检查、替换头像文件和清理旧头像互斥，防止清理掉刚生成的相同头像
+# 只在文件操作时持有，不在锁内解码、编码图片
+_files_lock = threading.Lock()
+# 以内容hash命名的头像路径（相对于static目录）
+_hashed_avatar_re = re.compile(r'^avatar/[0-9a-f]{2}/[0-9a-f]{40}-\w+\.(jpg|webp)$')
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='avatar')
+        return _executor
+
+
+# 头像上传错误，错误信息直接显示给用户
+class AvatarError(ValueError):
+    pass
+
+
+# 图片文件开头的特征字节（magic bytes）与格式
+_signatures = [(b'\xff\xd8\xff', 'JPEG'), (b'\x89PNG\r\n\x1a\n', 'PNG'),
+               (b'GIF87a', 'GIF'), (b'GIF89a', 'GIF')]
+
+
+# 由文件开头的字节判断图片格式，不是允许的图片格式时返回None
+def sniff_format(header):
+    for signature, format in _signatures:
+        if header.startswith(signature):
+            return format
+    return None
+
+
+# 上传的文件是否为允许的图片类型
+def allowed_avatar(fname):
+    return '.' in fname and \
+        fname.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+
+
+# 把上传的文件分块复制到AVATAR_DEST下的临时文件，同时计算sha1
+# 内存中最多只有一块数据，超过max_size时中止并删除临时文件
+# 返回(临时文件路径, sha1)
+def spool_upload(header, stream, max_size, chunk_size=64 * 1024):
+    dest = current_app.config['AVATAR_DEST']
+    os.makedirs(dest, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=dest, suffix='.upload')
+    h = hashlib.sha1()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            chunk = header
+            while chunk:
+                size += len(chunk)
+                if size > max_size:
+                    raise AvatarError('头像文件不能超过{}KB'.format(max_size // 1024))
+                h.update(chunk)
+                f.write(chunk)
+                chunk = stream.read(chunk_size)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, h.hexdigest()
+
+
+# 只读取图片的文件头，检查格式与特征字节一致、解码后的像素数不超过AVATAR_MAX_PIXELS，不解码图片
+# JPEG按draft()缩小后的尺寸计算，所以大尺寸照片仍可上传
+def check_image(path, format):
+    try:
+        with Image.open(path) as im:
+            if im.format != format:
+                raise AvatarError('文件类型错误')
+            w, h = draft(im, max(current_app.config['AVATAR_SIZES'].values()))
+    except (OSError, SyntaxError):
+        raise AvatarError('文件类型错误')
+    except Image.DecompressionBombError:
+        raise AvatarError('图片尺寸过大')
+    if w * h > current_app.config['AVATAR_MAX_PIXELS']:
+        raise AvatarError('图片尺寸过大')
+
+
+# 接收上传的头像，检查后交给后台线程处理并立即返回，文件不合要求时抛出AvatarError
+# 上传的文件先按块写入临时文件，后台线程从临时文件解码，处理完成后删除
+# 处理完成后更新用户的b_avatar、s_avatar；AVATAR_WORKERS为0时在当前线程处理
+def save_avatar(user, avatar):
+    if not allowed_avatar(avatar.filename):
+        raise AvatarError('文件类型错误')
+    header = avatar.stream.read(16)
+    format = sniff_format(header)
+    if format is None:
+        raise AvatarError('文件类型错误')
+    app = current_app._get_current_object()
+    path, file_hash = spool_upload(header, avatar.stream,
+                                   app.config['AVATAR_MAX_SIZE'])
+    try:
+        check_image(path, format)
+    except AvatarError:
+        os.remove(path)
+        raise
+    digest = avatar_hash(file_hash)
+    workers = app.config['AVATAR_WORKERS']
+    if not workers:
+        try:
+            update_avatar(user.id, path, digest)
+        finally:
+            os.remove(path)
+    else:
+        try:
+            _get_executor(workers).submit(process_avatar, app, user.id, path,
+                                          digest)
+        except BaseException:
+            # 没有交给后台线程（如线程池已关闭）时由这里删除临时文件
+            os.remove(path)
+            raise
+
+
+# JPEG用draft()让解码器直接按1/2、1/4、1/8缩小解码，短边仍不小于size
+# 只设置解码参数，不解码图片，返回实际解码的尺寸
+def draft(im, size):
+    w, h = im.size
+    short = min(w, h)
+    if im.format == 'JPEG' and short > size:
+        im.draft('RGB', (w * size // short, h * size // short))
+    return im.size
+
+
+# 解码图片并裁剪出中间的正方形，边长不小于size，大图不必按原尺寸解码
+def load_square(source, size):
+    im = Image.open(source)
+    w, h = draft(im, size)
+    short = min(w, h)
+    im = im.convert('RGB')
+    left = (w - short) // 2
+    top = (h - short) // 2
+    return im.crop((left, top, left + short, top + short))
+
+
+# 把正方形图片缩放到size x size
+# 先用reduce()整数倍缩小，再用LANCZOS缩放到准确尺寸，避免在大图上做高质量缩放
+# Pillow 7.0之前没有reduce()，改用BOX滤镜缩小到相同尺寸（同样是按块取平均）
+def scale_square(im, size):
+    factor = im.size[0] // size
+    if factor >= 2:
+        reduce = getattr(im, 'reduce', None)
+        if reduce is not None:
+            im = reduce(factor)
+        else:
+            side = -(-im.size[0] // factor)
+            im = im.resize((side, side), Image.BOX)
+    if im.size != (size, size):
+        im = im.resize((size, size), Image.LANCZOS)
+    return im
+
+
+# 把图片写入path同一目录下的临时文件，返回临时文件路径
+# 之后再用os.replace替换为path，读取方不会读到写了一半的文件
+def save_temp(im, path, format, **params):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, format, **params)
+        os.chmod(tmp, 0o644)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return tmp
+
+
+# 头像的内容hash：上传文件的sha1和生成参数（尺寸、质量）的sha1
+# 相同的图片得到相同的文件名，所有用户共用一份；修改生成参数后文件名随之改变
+def avatar_hash(file_hash):
+    config = current_app.config
+    h = hashlib.sha1(file_hash.encode('utf-8'))
+    h.update(repr((sorted(config['AVATAR_SIZES'].items()),
+                   config['AVATAR_QUALITY'])).encode('utf-8'))
+    return h.hexdigest()
+
+
+# 生成AVATAR_SIZES中各尺寸的头像（JPEG，AVATAR_WEBP为True时另存一份WebP）
+# 文件名为<hash前两位>/<hash>-<尺寸名称>.jpg，文件已存在时不再重复生成
+# 图片只解码一次，各尺寸由同一张正方形图片缩放得到
+# source为上传图片的文件路径或文件对象，digest为avatar_hash得到的头像hash
+# 返回{尺寸名称: JPEG头像的路径}，路径相对于AVATAR_DEST
+def write_avatar(source, digest):
+    config = current_app.config
+    sizes = config['AVATAR_SIZES']
+    dirname = digest[:2]
+    dest = os.path.join(config['AVATAR_DEST'], dirname)
+    paths = {name: '{}/{}-{}.jpg'.format(dirname, digest, name)
+             for name in sizes}
+    exts = ['jpg', 'webp'] if config['AVATAR_WEBP'] else ['jpg']
+    files = [os.path.join(dest, '{}-{}.{}'.format(digest, name, ext))
+             for name in sizes for ext in exts]
+    with _files_lock:
+        if all(os.path.exists(f) for f in files):
+            # 重新使用已有的文件时更新修改时间，清理头像时不会在提交前被删除
+            for f in files:
+                os.utime(f)
+            return paths
+    # 解码、缩放和编码不持有锁，多个头像可以同时处理
+    os.makedirs(dest, exist_ok=True)
+    square = load_square(source, max(sizes.values()))
+    temps = []
+    try:
+        for name, size in sizes.items():
+            im = scale_square(square, size)
+            path = os.path.join(dest, '{}-{}'.format(digest, name))
+            temps.append((save_temp(im, path + '.jpg', 'JPEG',
+                                    quality=config['AVATAR_QUALITY']),
+                          path + '.jpg'))
+            if config['AVATAR_WEBP']:
+                temps.append((save_temp(im, path + '.webp', 'WEBP',
+                                        quality=config['AVATAR_QUALITY']),
+                              path + '.webp'))
+        with _files_lock:
+            while temps:
+                tmp, path = temps.pop()
+                os.replace(tmp, path)
+    finally:
+        for tmp, _ in temps:
+            os.remove(tmp)
+    return paths
+
+
+# 头像文件是否在AVATAR_GC_GRACE秒内写入过
+# 其他进程可能刚写入头像文件、还没有提交用户的头像路径，_files_lock只能防止本进程内的竞争，
+# 所以清理头像时跳过最近写入的文件
+def _recently_written(f, now):
+    try:
+        return now - os.path.getmtime(f) < current_app.config['AVATAR_GC_GRACE']
+    except FileNotFoundError:
+        return True
+
+
+# 删除不再被任何用户使用的头像文件（含同一hash的所有尺寸和格式），default目录下和最近写入的除外
+def remove_unused_avatars(paths):
+    dest = current_app.config['AVATAR_DEST']
+    now = time.time()
+    for path in set(paths):
+        if not path or path.startswith('default/'):
+            continue
+        if User.query.filter(db.or_(User.b_avatar == path,
+                                    User.s_avatar == path)).count():
+            continue
+        name = os.path.join(dest, path)
+        match = _hashed_avatar_re.match('avatar/' + path)
+        if match:
+            files = glob.glob(name.rsplit('-', 1)[0] + '-*')
+        else:
+            files = [name, os.path.splitext(name)[0] + '.webp']
+        for f in files:
+            if not _recently_written(f, now):
+                os.remove(f)
+
+
+# 清理所有不再被使用的内容hash头像（最近写入的除外），返回删除的文件数
+def gc_avatars():
+    dest = current_app.config['AVATAR_DEST']
+    now = time.time()
+    used = set()
+    for b_avatar, s_avatar in db.session.query(User.b_avatar, User.s_avatar):
+        used.update(path.rsplit('-', 1)[0] for path in (b_avatar, s_avatar)
+                    if path)
+    count = 0
+    with _files_lock:
+        for f in glob.glob(os.path.join(dest, '??', '*-*.*')):
+            path = os.path.relpath(f, dest).replace(os.sep, '/')
+            if _hashed_avatar_re.match('avatar/' + path) and \
+                    path.rsplit('-', 1)[0] not in used and \
+                    not _recently_written(f, now):
+                os.remove(f)
+                count += 1
+    return count
+
+
+# 生成头像后更新用户的大头像、小头像路径，并删除用户不再使用的旧头像
+def update_avatar(user_id, source, digest):
+    user = User.query.get(user_id)
+    old = [user.b_avatar, user.s_avatar]
+    paths = write_avatar(source, digest)
+    User.query.filter_by(id=user_id).update(
+        {User.b_avatar: paths['big'], User.s_avatar: paths['small']},
+        synchronize_session=False)
+    forget_users([user_id])
+    db.session.commit()
+    with _files_lock:
+        remove_unused_avatars(old)
+    response_cache.clear()
+
+
+# 后台线程任务，处理完成后删除上传的临时文件
+def process_avatar(app, user_id, path, digest):
+    with app.app_context():
+        try:
+            update_avatar(user_id, path, digest)
+        except Exception:
+            app.logger.exception('处理用户%s的头像失败', user_id)
+            db.session.rollback()
+        finally:
+            db.session.remove()
+            os.remove(path)
+
+
+# 以内容hash命名的头像内容永不改变，允许浏览器和代理缓存一年且无须重新验证
+def immutable_avatar_headers(response):
+    if request.endpoint == 'static' and response.status_code in (200, 304) \
+            and _hashed_avatar_re.match(request.view_args.get('filename', '')):
+        response.headers['Cache-Control'] = \
+            'public, max-age=31536000, immutable'
+    return response
+
+
+# 读取头像文件，不超过max_size字节时返回data URI，否则返回None
+# 头像文件以内容hash命名，内容不会改变，结果可以一直缓存
+@lru_cache(maxsize=1024)
+def _inline_avatar(dest, path, max_size):
+    name = os.path.join(dest, path)
+    try:
+        if os.path.getsize(name) > max_size:
+            return None
+        with open(name, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii')
+
+
+# 模板中头像的src
+# 小于AVATAR_INLINE_MAX_SIZE字节的头像直接内嵌为data URI，列表页不必为每个头像再发一次请求；
+# 较大的头像或AVATAR_INLINE_MAX_SIZE为0时返回静态文件地址
+def avatar_url(path):
+    config = current_app.config
+    if config['AVATAR_INLINE_MAX_SIZE']:
+        uri = _inline_avatar(config['AVATAR_DEST'], path,
+                             config['AVATAR_INLINE_MAX_SIZE'])
+        if uri is not None:
+            return uri
+    return url_for('static', filename='avatar/' + path)
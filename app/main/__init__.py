@@ -5,10 +5,15 @@ main = Blueprint('main', __name__)
 
 from . import views, errors
 from ..models import Permission
+from ..image import avatar_url
 
 # 把Permission加入上下文
 # 使得模板在需要检查用户权限时，可以直接使用Permission
 # 不用频繁在render_template中传人(Permission=Permisson)
 @main.app_context_processor
 def inject_permissions():
-    return dict(Permission=Permission)
\ No newline at end of file
+    return dict(Permission=Permission)
+
+
+# 模板中可以直接使用avatar_url生成小头像的地址
+main.add_app_template_global(avatar_url)
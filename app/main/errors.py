@@ -1,4 +1,4 @@
-from flask import render_template
+from flask import render_template, request, current_app, abort
 from . import main
 
 
@@ -14,6 +14,21 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+# 请求体的长度超过MAX_CONTENT_LENGTH时，在读取请求体之前直接返回413
+# 由create_app在注册蓝本之前注册，先于各蓝本的before_app_request运行，不会先载入用户
+# 没有Content-Length的请求由werkzeug在读取超过限制时返回413
+def reject_large_request():
+    limit = current_app.config['MAX_CONTENT_LENGTH']
+    if limit and (request.content_length or 0) > limit:
+        abort(413)
+
+
+# 413错误（请求体超过MAX_CONTENT_LENGTH）
+@main.app_errorhandler(413)
+def request_entity_too_large(e):
+    return render_template('413.html'), 413
+
+
 # 500错误
 @main.app_errorhandler(500)
 def internal_server_error(e):
@@ -1,86 +1,167 @@
 import os
 from datetime import datetime
 from flask import render_template, redirect, request, url_for, flash, \
-    current_app
+    current_app, jsonify, make_response
 from flask_login import current_user, login_required
 from . import main
 from .forms import EditProfileAdminForm, PostForm, CommentForm
-from .. import db
-from ..post import create_abstract
-from ..models import User, Permission, Post, Comment, Follow, View, PostLike
+from .. import db, response_cache
+from ..buffer import view_buffer
+from ..email import mail_queue
+from ..image import save_avatar, AvatarError
+from ..conditional import make_etag, add_validators, not_modified_response
+from ..pagination import KeysetPagination
+from ..search import search_index, highlight, SearchPagination
+from ..models import User, Permission, Post, Comment, Follow, Timeline
 from ..decorators import admin_required, permission_required
 
 
+# 批量加载文章列表所需的数据（作者、关注状态）
+# 每类数据只用一次查询，查询次数不随每页文章数量增加
+# 评论数和点赞数已存储在posts表中，无须另行统计
+def load_post_list(posts):
+    author_ids = {post.author_id for post in posts}
+    if not author_ids:
+        return dict(authors={}, followed_ids=set())
+    # 作者（一次IN查询，同时填充会话的identity map，post.author不再另行查询）
+    authors = {user.id: user for user in
+               User.query.filter(User.id.in_(author_ids)).all()}
+    # 当前用户关注了哪些作者
+    followed_ids = current_user.following_ids(author_ids)
+    return dict(authors=authors, followed_ids=followed_ids)
+
+
+# 批量加载关注列表所需的数据（文章数、关注状态）
+# 每类数据只用一次查询，查询次数不随每页用户数量增加
+# 粉丝数和关注数已存储在users表中，无须另行统计
+def load_follow_list(users):
+    user_ids = [user.id for user in users]
+    posts_counts = dict.fromkeys(user_ids, 0)
+    if not user_ids:
+        return dict(posts_counts=posts_counts, followed_ids=set())
+    posts_counts.update(db.session.query(Post.author_id, db.func.count())
+                        .filter(Post.author_id.in_(user_ids))
+                        .group_by(Post.author_id).all())
+    return dict(posts_counts=posts_counts,
+                followed_ids=current_user.following_ids(user_ids))
+
+
+# 关注列表中用户的查询，只取出列表需要的列
+# 结果为(用户, 关注时间, 用户id)，id_column为关注表中列出的用户一方的id
+def follow_list_query(id_column):
+    return db.session.query(User, Follow.timestamp, id_column)\
+        .join(Follow, id_column == User.id)\
+        .options(db.load_only(User.id, User.username, User.name,
+                              User.s_avatar, User.followers_count,
+                              User.following_count))
+
+
+# 渲染文章列表页面
+# 先由列表中文章、作者的数据和关注状态生成ETag，
+# 客户端缓存仍有效时直接返回304，不再渲染模板
+# kwargs为模板的其他参数
+def render_post_list(template, pagination, **kwargs):
+    posts = pagination.items
+    context = load_post_list(posts)
+    etag = make_etag(
+        template, request.full_path, pagination.has_prev,
+        pagination.has_next, pagination.total,
+        [(post.id, post.title, post.abstract, post.ctime, post.views_count,
+          post.comments_count, post.likes_count) for post in posts],
+        sorted((user.id, user.username, user.name, user.s_avatar)
+               for user in context['authors'].values()),
+        sorted(context['followed_ids']))
+    response = not_modified_response(etag)
+    if response is not None:
+        return response
+    response = make_response(render_template(
+        template, posts=posts, pagination=pagination, **context, **kwargs))
+    return add_validators(response, etag)
+
+
+# 定期把缓冲的阅读记录批量写入数据库
+# 后台线程没有启动或未能及时写入时（如多进程部署），由请求结束时补充写入
+@main.after_app_request
+def flush_views(response):
+    if view_buffer.is_due():
+        # 先结束本请求的数据库会话（未提交的改动在请求结束时本来也会被回滚），
+        # 写入阅读记录时不必等待本请求持有的锁
+        db.session.remove()
+        view_buffer.flush()
+    return response
+
+
 # 网站主页(最新)
 @main.route('/')
+@response_cache.cached
 def index():
-    # 当前页数，默认为1
-    page = request.args.get('page', 1, type=int)
-    # 每页的文章，per_page为每页显示的文章数量
-    # error_out为False时，当请求页数超出范围时，返回空列表
-    # error_out为True时，当请求页数超出范围时，返回404
-    pagination = Post.query.order_by(Post.ctime.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    return render_template('index.html', posts=posts, pagination=pagination)
+    # 按(发表时间, id)游标分页，请求参数after/before为翻页游标
+    # 文章总数缓存PAGINATION_COUNT_TTL秒，不必每页都执行COUNT(*)
+    pagination = KeysetPagination.from_request(
+        Post.query, [Post.ctime, Post.id],
+        per_page=current_app.config['POSTS_PER_PAGE'], count_key='posts')
+    return render_post_list('index.html', pagination)
 
 
 # 网站主页(最热)
 @main.route('/index_views')
+@response_cache.cached
 def index_views():
-    # 当前页数，默认为1
-    page = request.args.get('page', 1, type=int)
-    # 每页的文章，per_page为每页显示的文章数量
-    # error_out为False时，当请求页数超出范围时，返回空列表
-    # error_out为True时，当请求页数超出范围时，返回404
-    pagination = Post.query.order_by(Post.views_count.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    return render_template('index_views.html', posts=posts, pagination=pagination)
+    # 按(阅读数, id)游标分页，由(views_count, id)索引直接定位，
+    # 翻到多深都不需要OFFSET和COUNT(*)
+    pagination = KeysetPagination.from_request(
+        Post.query, [Post.views_count, Post.id],
+        per_page=current_app.config['POSTS_PER_PAGE'])
+    return render_post_list('index_views.html', pagination)
 
 
 # 网站主页(关注)
 @main.route('/index_followed')
+@login_required
 def index_followed():
-    # 当前页数，默认为1
-    page = request.args.get('page', 1, type=int)
-    # 每页的文章，per_page为每页显示的文章数量
-    # error_out为False时，当请求页数超出范围时，返回空列表
-    # error_out为True时，当请求页数超出范围时，返回404
-    pagination = current_user.followed_posts.order_by(Post.ctime.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    return render_template('index_followed.html', posts=posts, pagination=pagination)
+    # 从关注动态表按(user_id, ctime, post_id)索引读取一段
+    pagination = KeysetPagination.from_request(
+        current_user.followed_posts, [Timeline.ctime, Timeline.post_id],
+        per_page=current_app.config['POSTS_PER_PAGE'], keys=['ctime', 'id'])
+    return render_post_list('index_followed.html', pagination)
 
 
 # 网站主页(我的)
 @main.route('/index_mine')
 def index_mine():
-    # 当前页数，默认为1
-    page = request.args.get('page', 1, type=int)
-    # 每页的文章，per_page为每页显示的文章数量
-    # error_out为False时，当请求页数超出范围时，返回空列表
-    # error_out为True时，当请求页数超出范围时，返回404
-    pagination = current_user.posts.order_by(Post.ctime.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
-    posts = pagination.items
-    return render_template('index_mine.html', posts=posts, pagination=pagination)
+    pagination = KeysetPagination.from_request(
+        current_user.posts, [Post.ctime, Post.id],
+        per_page=current_app.config['POSTS_PER_PAGE'])
+    return render_post_list('index_mine.html', pagination)
+
+
+# 搜索文章
+@main.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    ids, total = search_index().search(q, (page - 1) * per_page, per_page)
+    posts = {post.id: post for post in
+             Post.query.filter(Post.id.in_(ids)).all()} if ids else {}
+    # 按索引中的相关度顺序排列，跳过索引中已被删除的文章
+    pagination = SearchPagination([posts[id] for id in ids if id in posts],
+                                  page, per_page, total)
+    return render_post_list('search.html', pagination, q=q,
+                            highlight=lambda text: highlight(text, q))
 
 
 # 个人主页(文章)
 @main.route('/user/<username>')
+@response_cache.cached
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter_by(author=user).order_by(Post.ctime.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = KeysetPagination.from_request(
+        Post.query.filter_by(author=user), [Post.ctime, Post.id],
+        per_page=current_app.config['POSTS_PER_PAGE'])
     posts = pagination.items
-    return render_template('user.html', user=user, posts=posts, pagination=pagination)
+    return render_template('user.html', user=user, posts=posts, pagination=pagination,
+                           **load_post_list(posts))
 
 
 # 个人主页（关注的人）
@@ -90,14 +171,15 @@ def user_followed_by(username):
     if user is None:
         flash('没有此用户')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.order_by(Follow.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FOLLOWERS_PER_PAGE'],
-        error_out=False)
-    follows = [item.followed for item in pagination.items]
+    pagination = KeysetPagination.from_request(
+        follow_list_query(Follow.followed_id)
+        .filter(Follow.follower_id == user.id),
+        [Follow.timestamp, Follow.followed_id],
+        per_page=current_app.config['FOLLOWERS_PER_PAGE'])
+    follows = [item.User for item in pagination.items]
     return render_template('followed.html', user=user,
                            endpoint='main.user_followed_by', pagination=pagination,
-                           follows=follows)
+                           follows=follows, **load_follow_list(follows))
 
 
 # 个人主页（粉丝）
@@ -107,14 +189,15 @@ def user_followers(username):
     if user is None:
         flash('没有此用户')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    pagination = user.follower.paginate(
-        page, per_page=current_app.config['FOLLOWERS_PER_PAGE'],
-        error_out=False)
-    follows = [item.follower for item in pagination.items]
+    pagination = KeysetPagination.from_request(
+        follow_list_query(Follow.follower_id)
+        .filter(Follow.followed_id == user.id),
+        [Follow.timestamp, Follow.follower_id],
+        per_page=current_app.config['FOLLOWERS_PER_PAGE'])
+    follows = [item.User for item in pagination.items]
     return render_template('follower.html', user=user,
                            endpoint='main.user_followers', pagination=pagination,
-                           follows=follows)
+                           follows=follows, **load_follow_list(follows))
 
 
 # 管理员编辑用户个人资料界面
@@ -133,22 +216,18 @@ def edit_profile_admin(id):
         user.about_me = form.about_me.data
         # 提交用户头像
         avatar = request.files['avatar']
-        fname = avatar.filename
-        flag = '.' in fname and \
-            fname.rsplit('.', 1)[1] in current_app.config['ALLOWED_EXTENSIONS']
-        if not flag:
-            flash('文件类型错误')
-            return redirect(url_for('main.user', username=user.username))
-        # /static/avatar/ 文件夹里的保存的用户头像文件名
-        flname = user.username + '.' + fname.rsplit('.', 1)[1]
-        # 保存头像到指定路径
-        avatar.save(os.path.join(current_app.config['AVATAR_DEST'], flname))
-        user.avatar = flname
+        if avatar:
+            try:
+                save_avatar(user, avatar)
+            except AvatarError as e:
+                flash(str(e))
+                return redirect(url_for('main.user', username=user.username))
         db.session.add(user)
         db.session.commit()
+        response_cache.clear()
         flash('用户的个人资料已更新')
         return redirect(url_for('main.user', username=user.username))
-    form.avatar.data = os.path.join(current_app.config['AVATAR_DEST'], user.avatar)
+    form.avatar.data = os.path.join(current_app.config['AVATAR_DEST'], user.b_avatar)
     form.email.data = user.email
     form.username.data = user.username
     form.confirmed.data = user.confirmed
@@ -168,9 +247,11 @@ def write():
         post = Post(title=form.title.data, body=form.body.data,
                     author=current_user._get_current_object())
         db.session.add(post)
+        # 生成文章id和发表时间后，在同一事务中写入粉丝的关注动态
+        db.session.flush()
+        Timeline.fan_out(post)
         db.session.commit()
-        # 生成摘要
-        create_abstract(post.id)
+        response_cache.clear()
         flash('保存成功')
         return redirect(url_for('main.index'))
     return render_template('write.html', form=form)
@@ -178,6 +259,7 @@ def write():
 
 # 显示文章界面
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@response_cache.cached
 def post(id):
     post = Post.query.get_or_404(id)
     form = CommentForm()
@@ -186,30 +268,50 @@ def post(id):
                           post=post,
                           author=current_user._get_current_object())
         db.session.add(comment)
+        # 文章评论数在同一事务中+1
+        post.comments_count = Post.comments_count + 1
         flash('成功发表评论')
         db.session.add(post)
         db.session.commit()
-        # page=-1为最后一页评论，以便显示刚提交的评论
-        return redirect(url_for('main.post', id=post.id, page=-1))
-    page = request.args.get('page', 1, type=int)
-    if page == -1:
-        # 计算最后一页
-        page = (post.comments.count() - 1) // \
-            current_app.config['COMMENTS_PER_PAGE'] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['COMMENTS_PER_PAGE'],
-        error_out=False)
+        response_cache.clear()
+        # last=1为最后一页评论，以便显示刚提交的评论
+        return redirect(url_for('main.post', id=post.id, last=1,
+                                _anchor='comments'))
+    # 评论按(发表时间, id)升序游标分页
+    pagination = KeysetPagination.from_request(
+        post.comments, [Comment.timestamp, Comment.id],
+        per_page=current_app.config['COMMENTS_PER_PAGE'], desc=False)
     comments = pagination.items
-    # 如果登陆的用户之前没有读过这篇文章，那么文章阅读者中加入用户，文章阅读数+1
+    # 登陆用户的阅读记录写入缓冲区，由后台线程去重后批量写入，GET请求不写数据库
     if current_user.is_authenticated:
-        if not current_user.is_viewed(post.id):
-            view = View(post_id=post.id, viewer_id=current_user.id)
-            post.views_count += 1
-            db.session.add(view)
-    db.session.add(post)
-    db.session.commit()
-    return render_template('post.html', post=post, form=form,
-                            comments=comments, pagination=pagination)
+        view_buffer.add(post.id, current_user.id)
+    # 一次查询载入文章作者和本页评论的作者
+    author_ids = {comment.author_id for comment in comments}
+    author_ids.add(post.author_id)
+    authors = User.query.filter(User.id.in_(author_ids)).all()
+    # 由文章、本页评论、点赞的版本数据生成ETag，只用ETag验证缓存：
+    # 编辑文章、点赞、阅读都会改变页面，没有可靠的最后修改时间，不设置Last-Modified
+    # 新增评论由评论数反映，ETag只用已经载入的数据，不再另行查询
+    liked = following = None
+    if current_user.is_authenticated:
+        liked = current_user.is_post_liked(post.id)
+        following = current_user.is_following(post.author)
+    etag = make_etag(
+        request.full_path, post.title, post.body_hash, post.views_count,
+        post.comments_count, post.likes_count,
+        [(comment.id, comment.body_hash) for comment in comments],
+        pagination.has_prev,
+        pagination.has_next,
+        sorted((user.id, user.name, user.s_avatar) for user in authors),
+        liked, following, csrf=current_user.can(Permission.COMMENT))
+    response = not_modified_response(etag)
+    if response is not None:
+        return response
+    # 点赞、关注状态已经查询过，直接传给模板
+    response = make_response(render_template(
+        'post.html', post=post, form=form, comments=comments,
+        pagination=pagination, liked=liked, following=following))
+    return add_validators(response, etag)
 
 
 # 编辑文章
@@ -226,7 +328,7 @@ def edit(id):
         post.body = form.body.data
         db.session.add(post)
         db.session.commit()
-        create_abstract(post.id)
+        response_cache.clear()
         flash('文章已更新')
         return redirect(url_for('main.post', id=post.id))
     form.title.data = post.title
@@ -248,6 +350,7 @@ def follow(username):
         return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    response_cache.clear()
     if user.name:
         flash('成功关注{}'.format(user.name))
     else:
@@ -269,6 +372,7 @@ def unfollow(username):
         return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)
     db.session.commit()
+    response_cache.clear()
     if user.name:
         flash('取消关注{}'.format(user.name))
     else:
@@ -284,12 +388,12 @@ def post_like(id):
     post = Post.query.filter_by(id=id).first()
     if post is None:
         flash('文章不存在')
-    elif current_user.is_post_liked(id):
-        flash('您已经点赞过这篇文章')
-    else:
-        current_user.post_like(id)
+    elif current_user.post_like(id):
         db.session.commit()
+        response_cache.clear()
         flash('点赞成功')
+    else:
+        flash('您已经点赞过这篇文章')
     return redirect(url_for('main.post', id=id))
 
 
@@ -301,14 +405,26 @@ def post_unlike(id):
     post = Post.query.filter_by(id=id).first()
     if post is None:
         flash('文章不存在')
-    elif not current_user.is_post_liked(id):
-        flash('您还未点赞过这篇文章')
-    else:
-        current_user.post_unlike(id)
+    elif current_user.post_unlike(id):
         db.session.commit()
+        response_cache.clear()
         flash('取消点赞成功')
-    return redirect(url_for('main.post', id=id))  
-    
+    else:
+        flash('您还未点赞过这篇文章')
+    return redirect(url_for('main.post', id=id))
 
 
-    
\ No newline at end of file
+# 匿名用户页面缓存的命中次数和未命中次数
+@main.route('/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    return jsonify(response_cache.stats())
+
+
+# 邮件队列的长度和发送统计
+@main.route('/mail_queue_stats')
+@login_required
+@admin_required
+def mail_queue_stats():
+    return jsonify(mail_queue.stats())
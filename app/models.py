@@ -1,12 +1,17 @@
-import bleach
 import os
 from datetime import datetime
-from flask import current_app
+from types import MappingProxyType
+from flask import current_app, g
 from flask_login import UserMixin, AnonymousUserMixin
-from markdown import markdown
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from sqlalchemy.orm import make_transient_to_detached, object_session
 from . import db, login_manager
+from .buffer import last_login_buffer
+from .cache import user_cache, invalidate_users
+from .render import content_hash, make_abstract, render_cache
+from .search import search_index, update_index
+from .sql import insert_ignore
 
 
 # 用户权限定义
@@ -88,14 +93,45 @@ class Role(db.Model):
             role.default = (role.name==default_role)
             db.session.add(role)
         db.session.commit()
+        Role.load_table()
+
+    # 从数据库读入角色权限表，保存在current_app.extensions中
+    # 权限表只读：permissions为{角色id: 权限}，names为{角色名称: 角色id}，default为默认角色id
+    @staticmethod
+    def load_table():
+        roles = Role.query.all()
+        table = MappingProxyType({
+            'permissions': MappingProxyType(
+                {role.id: role.permissions for role in roles}),
+            'names': MappingProxyType({role.name: role.id for role in roles}),
+            'default': next((role.id for role in roles if role.default), None)
+        })
+        # 角色尚未生成时不保存，下次使用时再读入
+        if roles:
+            current_app.extensions['role_table'] = table
+        return table
+
+    # 角色权限表，第一次使用时读入，之后只在insert_roles时刷新
+    @staticmethod
+    def table():
+        table = current_app.extensions.get('role_table')
+        if table is None:
+            table = Role.load_table()
+        return table
 
     def __repr__(self):
         return '<Role {}>'.format(self.name)
 
 
 # 关注与被关注 关联表
+# 关注列表按(被关注者id, 关注时间, 关注者id)、(关注者id, 关注时间, 被关注者id)索引分页
 class Follow(db.Model):
     __tablename__ = 'follows'
+    __table_args__ = (
+        db.Index('ix_follows_followed_id_timestamp',
+                 'followed_id', 'timestamp', 'follower_id'),
+        db.Index('ix_follows_follower_id_timestamp',
+                 'follower_id', 'timestamp', 'followed_id'))
     # 关注者id
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
@@ -136,19 +172,23 @@ class User(UserMixin, db.Model):
     b_avatar = db.Column(db.String(128), default='default/big.jpg')
     # 用户小头像路径
     s_avatar = db.Column(db.String(128), default='default/small.jpg')
+    # 粉丝数（关注、取消关注时同步更新）
+    followers_count = db.Column(db.Integer, default=0)
+    # 关注数
+    following_count = db.Column(db.Integer, default=0)
     # 用户发表的文章
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     # 我的粉丝（关注我的人）
     follower = db.relationship('Follow',
                                 foreign_keys=[Follow.followed_id],
-                                backref=db.backref('followed', lazy='joined'),
+                                backref='followed',
                                 lazy='dynamic',
                                 # 启动所有层叠选项，删除孤儿记录
                                 cascade='all, delete-orphan')
     # 我关注的人
     followed = db.relationship('Follow',
                                foreign_keys=[Follow.follower_id],
-                               backref=db.backref('follower', lazy='joined'),
+                               backref='follower',
                                lazy='dynamic',
                                # 启动所有层叠选项，删除孤儿记录
                                cascade='all, delete-orphan')
@@ -161,11 +201,13 @@ class User(UserMixin, db.Model):
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        # 从角色权限表取得角色id，不查询数据库
+        if self.role is None and self.role_id is None:
+            table = Role.table()
             if self.email == current_app.config['MAIL_ADMIN']:
-                self.role = Role.query.filter_by(name='Administrator').first()
+                self.role_id = table['names'].get('Administrator')
             else:
-                self.role = Role.query.filter_by(default=True).first()
+                self.role_id = table['default']
 
     # 把password方法变为属性，读取属性
     @property
@@ -246,50 +288,111 @@ class User(UserMixin, db.Model):
         return True
 
     # 检查用户是否有某项权限
+    # 按角色id在角色权限表中检查，不访问数据库
+    # 新建用户只设置了role、尚未写入数据库时，直接检查role
     def can(self, perm):
-        return self.role is not None and self.role.has_permission(perm)
+        if self.role_id is None:
+            return self.role is not None and self.role.has_permission(perm)
+        permissions = Role.table()['permissions'].get(self.role_id, 0)
+        return (permissions & perm) == perm
 
     # 检查用户是否为管理员
     def is_administrator(self):
         return self.can(Permission.ADMIN)
 
     # 更新上次登陆时间
+    # 只写入缓冲区，合并窗口内的重复访问不再更新，由缓冲区定期批量写入数据库
     def update_last_login(self):
-        self.last_login = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
+        return last_login_buffer.touch(self)
 
-    # 关注用户
+    # 关注用户（同时把用户已发表的文章加入我的关注动态）
+    # 用INSERT IGNORE写入关注记录，只有真正新增记录时才在同一事务中更新双方的计数，
+    # 计数用UPDATE ... SET x = x + 1在数据库中累加，并发重复关注也不会多计
+    # 关注成功返回True，已关注过返回False
     def follow(self, user):
-        if not self.is_following(user):
-            f = Follow(follower=self, followed=user)
-            db.session.add(f)
+        self._following_state()[user.id] = True
+        result = db.session.execute(insert_ignore(Follow.__table__).values(
+            follower_id=self.id, followed_id=user.id,
+            timestamp=datetime.utcnow()))
+        if not result.rowcount:
+            return False
+        self._update_follow_counts(user, 1)
+        Timeline.add_author(self.id, user.id)
+        return True
 
-    # 取消关注用户
+    # 取消关注用户（同时从我的关注动态中删除用户的文章）
+    # 只有真正删除了关注记录时才更新双方的计数，取消成功返回True，未关注过返回False
     def unfollow(self, user):
-        f = self.followed.filter_by(followed_id=user.id).first()
-        if f:
-            db.session.delete(f)
+        self._following_state()[user.id] = False
+        if not Follow.query.filter_by(follower_id=self.id,
+                                      followed_id=user.id)\
+                .delete(synchronize_session=False):
+            return False
+        self._update_follow_counts(user, -1)
+        Timeline.remove_author(self.id, user.id)
+        return True
+
+    # 更新我的关注数和用户的粉丝数，同时清除双方的用户缓存
+    def _update_follow_counts(self, user, delta):
+        User.query.filter_by(id=self.id).update(
+            {User.following_count: User.following_count + delta})
+        User.query.filter_by(id=user.id).update(
+            {User.followers_count: User.followers_count + delta})
+        forget_users([self.id, user.id])
+
+    # 按关注表重新统计粉丝数和关注数
+    # 只更新与实际记录不一致的用户，返回被修正的用户数
+    @staticmethod
+    def update_follow_counts():
+        followers = db.select([db.func.count()])\
+            .where(Follow.followed_id == User.id).as_scalar()
+        following = db.select([db.func.count()])\
+            .where(Follow.follower_id == User.id).as_scalar()
+        count = User.query.filter(db.or_(
+            db.func.coalesce(User.followers_count, -1) != followers,
+            db.func.coalesce(User.following_count, -1) != following))\
+            .update({User.followers_count: followers,
+                     User.following_count: following},
+                    synchronize_session=False)
+        db.session.commit()
+        # 批量修正的用户不止一个，直接清空用户缓存
+        user_cache().clear()
+        return count
+
+    # 本次请求中已查过的关注状态 {用户id: 是否关注}，保存在g中，请求结束即丢弃
+    def _following_state(self):
+        return g.setdefault('following_state', {}).setdefault(self.id, {})
+
+    # 候选用户中我关注了哪些人，返回用户id的集合
+    # 一次IN查询得出整页用户的关注状态，本次请求内已查过的用户不再查询
+    def following_ids(self, candidate_ids):
+        candidate_ids = {id for id in candidate_ids if id is not None}
+        if self.id is None or not candidate_ids:
+            return set()
+        state = self._following_state()
+        missing = candidate_ids - state.keys()
+        if missing:
+            found = {row.followed_id for row in
+                     db.session.query(Follow.followed_id)
+                     .filter(Follow.follower_id == self.id,
+                             Follow.followed_id.in_(missing)).all()}
+            for id in missing:
+                state[id] = id in found
+        return {id for id in candidate_ids if state[id]}
 
     # 我是否关注了用户
     def is_following(self, user):
-        if user.id is None:
-            return False
-        return self.followed.filter_by(
-            followed_id=user.id).first() is not None
+        return user.id in self.following_ids([user.id])
 
     # 用户是否关注了我
     def is_followed_by(self, user):
-        if user.id is None:
-            return False
-        return self.followers.filter_by(
-            follower_id=user.id).first() is not None
+        return self.id in user.following_ids([self.id])
 
-    # 我关注的用户所写的文章
+    # 我关注的用户所写的文章（从关注动态表中读取，按Timeline.ctime, Timeline.post_id排序）
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id)\
-            .filter(Follow.follower_id == self.id)
+        return Post.query.join(Timeline, Timeline.post_id == Post.id)\
+            .filter(Timeline.user_id == self.id)
 
     # 用户是否阅读过该文章
     def is_viewed(self, post_id):
@@ -305,17 +408,26 @@ class User(UserMixin, db.Model):
             return True
         return False
 
-    # 点赞文章
+    # 点赞文章，依靠(liker_id, post_id)唯一索引忽略重复点赞
+    # 点赞成功返回True（文章点赞数在同一事务中+1），已点赞过返回False
     def post_like(self, id):
-        if not self.is_post_liked(id):
-            like = PostLike(post_id=id, liker_id=self.id)
-            db.session.add(like)
+        result = db.session.execute(insert_ignore(PostLike.__table__)
+                                    .values(post_id=id, liker_id=self.id))
+        if not result.rowcount:
+            return False
+        Post.query.filter_by(id=id).update(
+            {Post.likes_count: Post.likes_count + 1})
+        return True
 
-    # 取消关注用户
+    # 取消点赞文章
+    # 取消成功返回True（文章点赞数在同一事务中-1），未点赞过返回False
     def post_unlike(self, id):
-        unlike = self.liked_posts.filter_by(post_id=id).first()   
-        if unlike:
-            db.session.delete(unlike)
+        if not PostLike.query.filter_by(liker_id=self.id, post_id=id)\
+                .delete(synchronize_session=False):
+            return False
+        Post.query.filter_by(id=id).update(
+            {Post.likes_count: Post.likes_count - 1})
+        return True
 
     def __repr__(self):
         return '<User {}>'.format(self.username) 
@@ -331,6 +443,10 @@ class AnonymousUser(AnonymousUserMixin):
     # 检查匿名用户是否为管理员
     def is_administrator(self):
         return False
+
+    # 匿名用户没有关注任何人
+    def following_ids(self, candidate_ids):
+        return set()
        
 
 # 匿名用户为AnonymousUser类
@@ -340,6 +456,8 @@ login_manager.anonymous_user = AnonymousUser
 # 文章表
 class Post(db.Model):
     __tablename__ = 'posts'
+    # 最热文章按(阅读数, id)排序和分页
+    __table_args__ = (db.Index('ix_posts_views_count_id', 'views_count', 'id'),)
     # 文章id（主键）
     id = db.Column(db.Integer, primary_key=True)
     # 文章标题
@@ -362,27 +480,143 @@ class Post(db.Model):
     views_count = db.Column(db.Integer, default=0)
     # 点赞记录
     likes = db.relationship('PostLike', backref='post', lazy='dynamic')
+    # 评论数
+    comments_count = db.Column(db.Integer, default=0)
+    # 点赞数
+    likes_count = db.Column(db.Integer, default=0)
+
+    # 按评论表、点赞表重新统计评论数和点赞数
+    # 只更新与实际记录不一致的文章，返回被修正的文章数
+    @staticmethod
+    def update_counts():
+        comments = db.select([db.func.count(Comment.id)])\
+            .where(Comment.post_id == Post.id).as_scalar()
+        likes = db.select([db.func.count(PostLike.id)])\
+            .where(PostLike.post_id == Post.id).as_scalar()
+        count = Post.query.filter(db.or_(
+            db.func.coalesce(Post.comments_count, -1) != comments,
+            db.func.coalesce(Post.likes_count, -1) != likes))\
+            .update({Post.comments_count: comments, Post.likes_count: likes},
+                    synchronize_session=False)
+        db.session.commit()
+        return count
+
+    # 文章主体的hash值，文章主体没有变化时不再重新渲染
+    body_hash = db.Column(db.String(40))
+
+    # 允许存在的html标签
+    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+                    'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+                    'h1', 'h2', 'h3', 'p']
 
     # 把Markdown文本转化成html
     @staticmethod
     # target, value, oldvalue, initiator均由db.event.listen的set参数自行传人
     def on_change_body(target, value, oldvalue, initiator):
-        # 允许存在的html标签
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        # 把Markdown文本转换为html
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        digest = content_hash(value)
+        # 文章主体没有变化时不再重新渲染
+        if digest == target.body_hash and target.body_html is not None:
+            return
+        target.body_hash = digest
+        # 把Markdown文本转换为html（相同内容的渲染结果取自缓存）
+        target.body_html = render_cache.render(value, Post.allowed_tags, digest)
+        # 同时生成摘要，与文章在同一次flush中写入
+        target.abstract = make_abstract(target.body_html)
+
+    # 按文章表重建搜索索引，返回写入索引的文章数
+    @staticmethod
+    def reindex(chunk_size=500):
+        rows = db.session.query(Post.id, Post.title, Post.body_html)\
+            .yield_per(chunk_size)
+        return search_index().rebuild(rows)
 
 # 监听程序，Post.body有改动就运行Post.on_change_body
 db.event.listen(Post.body, 'set', Post.on_change_body)
 
 
+# 文章发表或标题、内容改变后，记下需要更新搜索索引的文章，事务提交后再写入索引
+def on_post_saved(mapper, connection, target):
+    attrs = db.inspect(target).attrs
+    if attrs.title.history.has_changes() or \
+            attrs.body_html.history.has_changes():
+        object_session(target).info.setdefault('indexed_posts', {})[
+            target.id] = (target.title, target.body_html)
+
+
+# 文章被删除后，事务提交后从搜索索引中删除
+def on_post_deleted(mapper, connection, target):
+    object_session(target).info.setdefault('indexed_posts', {})[
+        target.id] = None
+
+
+db.event.listen(Post, 'after_insert', on_post_saved)
+db.event.listen(Post, 'after_update', on_post_saved)
+db.event.listen(Post, 'after_delete', on_post_deleted)
+
+
+# 关注动态表（写扩散）
+# 发表文章时把文章写入每个粉丝的关注动态，
+# 关注页只需按(user_id, ctime, post_id)索引读取一段，不必每次联结posts和follows表
+class Timeline(db.Model):
+    __tablename__ = 'timelines'
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_ctime_post_id',
+                 'user_id', 'ctime', 'post_id'),
+        # 取消关注时按(粉丝id, 作者id)删除
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'))
+    # 粉丝id
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    # 文章id
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    # 作者id
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # 文章发表时间
+    ctime = db.Column(db.DateTime)
+
+    # 把新文章写入作者每个粉丝的关注动态（一条INSERT ... SELECT）
+    @staticmethod
+    def fan_out(post):
+        followers = db.select([Follow.follower_id, db.literal(post.id),
+                               db.literal(post.author_id),
+                               db.literal(post.ctime)])\
+            .where(Follow.followed_id == post.author_id)
+        db.session.execute(insert_ignore(Timeline.__table__).from_select(
+            ['user_id', 'post_id', 'author_id', 'ctime'], followers))
+
+    # 把作者已发表的文章加入粉丝的关注动态
+    @staticmethod
+    def add_author(user_id, author_id):
+        posts = db.select([db.literal(user_id), Post.id, Post.author_id,
+                           Post.ctime])\
+            .where(Post.author_id == author_id)
+        db.session.execute(insert_ignore(Timeline.__table__).from_select(
+            ['user_id', 'post_id', 'author_id', 'ctime'], posts))
+
+    # 从粉丝的关注动态中删除作者的文章
+    @staticmethod
+    def remove_author(user_id, author_id):
+        Timeline.query.filter_by(user_id=user_id, author_id=author_id)\
+            .delete(synchronize_session=False)
+
+    # 按关注关系重建所有用户的关注动态，返回写入的记录数
+    @staticmethod
+    def rebuild():
+        Timeline.query.delete(synchronize_session=False)
+        posts = db.select([Follow.follower_id, Post.id, Post.author_id,
+                           Post.ctime])\
+            .where(Follow.followed_id == Post.author_id)
+        count = db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'ctime'], posts)).rowcount
+        db.session.commit()
+        return count
+
+
 # 文章阅读者表
 class View(db.Model):
     __tablename__ = 'views'
+    # 同一用户对同一文章只有一条阅读记录
+    __table_args__ = (db.Index('ix_views_viewer_id_post_id',
+                               'viewer_id', 'post_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     viewer_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -391,6 +625,9 @@ class View(db.Model):
 # 文章点赞表
 class PostLike(db.Model):
     __tablename__ = 'post_likes'
+    # 同一用户对同一文章只能点赞一次
+    __table_args__ = (db.Index('ix_post_likes_liker_id_post_id',
+                               'liker_id', 'post_id', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     liker_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -406,20 +643,100 @@ class Comment(db.Model):
     disabled = db.Column(db.Boolean)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
+    body_hash = db.Column(db.String(40))
+
+    allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
+                    'strong']
 
     @staticmethod
     def on_change_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i',
-                         'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        digest = content_hash(value)
+        if digest == target.body_hash and target.body_html is not None:
+            return
+        target.body_hash = digest
+        target.body_html = render_cache.render(value, Comment.allowed_tags, digest)
 
 
 # 监听程序，Comment.body有改动就运行Comment.on_change_body
 db.event.listen(Comment.body, 'set', Comment.on_change_body)
 
 
+# 载入登陆用户
+# 开启用户缓存时先从缓存中取出用户各列的值，组装成已持久化的用户对象，不查询数据库；
+# 缓存未命中时用一条查询同时载入用户和角色
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
\ No newline at end of file
+    user_id = int(user_id)
+    timeout = current_app.config['USER_CACHE_TIMEOUT']
+    data = user_cache().get(user_id) if timeout else None
+    if data is None:
+        user = User.query.options(db.joinedload(User.role)).get(user_id)
+        if user is not None and timeout:
+            user_cache().set(user_id, {
+                attr.key: getattr(user, attr.key)
+                for attr in db.inspect(User).column_attrs}, timeout)
+        return user
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+# 清除用户缓存，事务提交后再清除一次，防止提交前其他请求又把旧数据读入缓存
+def forget_users(user_ids, session=None):
+    session = session or db.session
+    invalidate_users(user_ids)
+    session.info.setdefault('changed_users', set()).update(user_ids)
+
+
+# 用户被修改或删除后清除缓存
+def on_user_changed(mapper, connection, target):
+    forget_users([target.id], object_session(target))
+
+
+def on_commit(session):
+    invalidate_users(session.info.pop('changed_users', ()))
+    posts = session.info.pop('indexed_posts', None)
+    if posts:
+        update_index(posts)
+
+
+# 事务回滚后丢弃未提交的文章改动，不写入搜索索引
+def on_rollback(session):
+    session.info.pop('indexed_posts', None)
+
+
+db.event.listen(User, 'after_update', on_user_changed)
+db.event.listen(User, 'after_delete', on_user_changed)
+db.event.listen(db.session, 'after_commit', on_commit)
+db.event.listen(db.session, 'after_rollback', on_rollback)
+
+
+# 邮件队列表
+# 发送成功的邮件直接删除，表中只保留待发送和多次发送失败的邮件
+class MailJob(db.Model):
+    __tablename__ = 'mail_queue'
+    __table_args__ = (db.Index('ix_mail_queue_status_next_attempt',
+                               'status', 'next_attempt'),)
+    id = db.Column(db.Integer, primary_key=True)
+    # 发件人
+    sender = db.Column(db.String(128))
+    # 收件人（多个收件人用逗号分隔）
+    recipients = db.Column(db.Text)
+    # 邮件标题
+    subject = db.Column(db.String(128))
+    # 纯文本正文
+    body = db.Column(db.Text)
+    # html正文
+    html = db.Column(db.Text)
+    # 状态：pending（待发送）、failed（超过最大重试次数）
+    status = db.Column(db.String(16), default='pending')
+    # 已尝试发送的次数
+    attempts = db.Column(db.Integer, default=0)
+    # 下次可以发送的时间（被领取后推迟到领取超时的时间）
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow)
+    # 领取标记，每批领取的邮件有相同的标记
+    claim = db.Column(db.String(32))
+    # 最近一次发送失败的原因
+    last_error = db.Column(db.Text)
+    # 加入队列的时间
+    created = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,134 @@
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import and_, or_, DateTime
+from .cache import SimpleCache
+
+
+# 分页总数缓存 {count_key: 总数}，每个应用一份，保存在app.extensions中
+def count_cache():
+    cache = current_app.extensions.get('pagination_count_cache')
+    if cache is None:
+        cache = current_app.extensions.setdefault(
+            'pagination_count_cache',
+            SimpleCache(current_app.config['PAGINATION_COUNT_CACHE_SIZE']))
+    return cache
+
+
+# 游标分页（keyset/seek分页）
+# 按(排序字段..., id)排序，用上一页最后一条记录的排序值作为游标，
+# 通过WHERE条件直接定位到下一页，不使用OFFSET，默认也不统计总数，
+# 所以无论翻到多深，每页的查询代价都和第一页相同
+class KeysetPagination:
+    # 游标中各字段值的分隔符
+    separator = '_'
+
+    # query: 查询, columns: 排序字段（最后一个必须唯一，通常为id）
+    # after: 向后翻页的游标, before: 向前翻页的游标, desc: 是否降序
+    # last: 没有游标时是否显示最后一页
+    # count_key: 总数的缓存键，为None时不统计总数
+    # keys: 从记录中读取排序值的属性名，默认与排序字段同名
+    def __init__(self, query, columns, per_page, after=None, before=None,
+                 desc=True, last=False, count_key=None, keys=None):
+        self.columns = columns
+        self.keys = keys or [column.key for column in columns]
+        self.per_page = per_page
+        self.desc = desc
+        self.total = self._count(query, count_key) if count_key else None
+        after = self.decode(after)
+        before = self.decode(before) if after is None else None
+        # 向前翻页（或显示最后一页）时按相反的顺序查询，取出后再反转
+        backward = before is not None or (last and after is None)
+        cursor = before if backward else after
+        if cursor is not None:
+            query = query.filter(self._seek(cursor, backward))
+        query = query.order_by(*self._order(backward))
+        # 多取一条，用来判断是否还有下一页
+        items = query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        items = items[:per_page]
+        if backward:
+            items.reverse()
+            self.has_prev, self.has_next = more, cursor is not None
+        else:
+            self.has_prev, self.has_next = cursor is not None, more
+        self.items = items
+
+    # 从请求参数after、before、last中读取游标，创建分页对象
+    @classmethod
+    def from_request(cls, query, columns, per_page, **kwargs):
+        return cls(query, columns, per_page,
+                   after=request.args.get('after'),
+                   before=request.args.get('before'),
+                   last=request.args.get('last', 0, type=int) == 1,
+                   **kwargs)
+
+    # 第一条记录的游标，用于向前翻页
+    @property
+    def prev_cursor(self):
+        if not self.items:
+            return None
+        return self.encode(self.items[0])
+
+    # 最后一条记录的游标，用于向后翻页
+    @property
+    def next_cursor(self):
+        if not self.items:
+            return None
+        return self.encode(self.items[-1])
+
+    # 把记录的排序值编码为游标字符串
+    def encode(self, item):
+        values = []
+        for key in self.keys:
+            value = getattr(item, key)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            values.append(str(value))
+        return self.separator.join(values)
+
+    # 把游标字符串解码为排序值，游标无效时返回None（即从第一页开始）
+    def decode(self, cursor):
+        if not cursor:
+            return None
+        parts = cursor.split(self.separator)
+        if len(parts) != len(self.columns):
+            return None
+        values = []
+        try:
+            for column, part in zip(self.columns, parts):
+                if isinstance(column.type, DateTime):
+                    values.append(datetime.fromisoformat(part))
+                else:
+                    values.append(int(part))
+        except ValueError:
+            return None
+        return values
+
+    # 定位条件：(a, b) < (x, y) 展开为 a < x OR (a = x AND b < y)
+    # 展开后的条件可以直接使用(a, b)上的联合索引
+    def _seek(self, cursor, backward):
+        less = self.desc != backward
+        clause = None
+        for column, value in reversed(list(zip(self.columns, cursor))):
+            compare = column < value if less else column > value
+            if clause is None:
+                clause = compare
+            else:
+                clause = or_(compare, and_(column == value, clause))
+        return clause
+
+    def _order(self, backward):
+        if self.desc != backward:
+            return [column.desc() for column in self.columns]
+        return [column.asc() for column in self.columns]
+
+    # 统计总数，结果缓存PAGINATION_COUNT_TTL秒，缓存期内的总数可能略有偏差
+    @staticmethod
+    def _count(query, count_key):
+        cache = count_cache()
+        total = cache.get(count_key)
+        if total is None:
+            total = query.order_by(None).count()
+            cache.set(count_key, total,
+                      current_app.config['PAGINATION_COUNT_TTL'])
+        return total
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+import bleach
+from markdown import markdown
+
+
+# 计算Markdown文本的hash值（sha1十六进制字符串）
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+# 把Markdown文本转换为html，只保留allowed_tags中的标签，并把网址转换为链接
+def render_markdown(text, allowed_tags):
+    return bleach.linkify(bleach.clean(
+        markdown(text, output_format='html'),
+        tags=allowed_tags, strip=True))
+
+
+# 提取html纯文本的解析器
+class TextExtractor(HTMLParser):
+    def __init__(self):
+        super(TextExtractor, self).__init__(convert_charrefs=True)
+        self.parts = []
+        self.length = 0
+
+    def handle_data(self, data):
+        self.parts.append(data)
+        self.length += len(data)
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+
+# 从文章html生成摘要（去掉html标签后取前length个字符）
+# 把html分段交给解析器，取够字符后就不再解析剩下的内容，长文章不必整篇处理
+def make_abstract(html, length=60, chunk_size=1024):
+    parser = TextExtractor()
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+        if parser.length > length:
+            break
+    else:
+        parser.close()
+    abstract = parser.text
+    if len(abstract) > length:
+        return abstract[0:length] + '...'
+    return abstract
+
+
+# Markdown渲染结果的LRU缓存
+# 以(允许的标签, 文本hash)为键，相同内容只渲染一次，超过maxsize时淘汰最久未使用的结果
+class RenderCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    # 渲染Markdown文本，digest为文本的hash值（已经算过时可直接传入）
+    def render(self, text, allowed_tags, digest=None):
+        key = (tuple(allowed_tags), digest or content_hash(text))
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = render_markdown(text, allowed_tags)
+        with self._lock:
+            self._cache[key] = html
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+render_cache = RenderCache()
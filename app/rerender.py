@@ -0,0 +1,95 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from . import db
+from .render import content_hash, make_abstract, render_markdown
+
+
+# 渲染一批记录（在子进程中运行）
+# rows为[(id, Markdown文本)]，返回批量UPDATE所需的参数列表
+def render_rows(rows, allowed_tags, with_abstract):
+    results = []
+    for id, body in rows:
+        html = render_markdown(body, allowed_tags)
+        result = {'_id': id, 'body_html': html, 'body_hash': content_hash(body)}
+        if with_abstract:
+            result['abstract'] = make_abstract(html)
+        results.append(result)
+    return results
+
+
+# 读取断点文件 {表名: 已处理到的最大id}
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+# 写入断点文件（先写临时文件再替换，中断时不会留下损坏的断点文件）
+# checkpoint为空时删除断点文件
+def save_checkpoint(path, checkpoint):
+    if not path:
+        return
+    if not checkpoint:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+# 重新渲染model（Post或Comment）所有记录的body_html（文章同时重新生成摘要）
+# 按id顺序每次读取chunk_size条记录，拆分后交给进程池渲染，再用批量UPDATE写回，
+# 每批提交后把已处理到的id写入断点文件，中断后再次运行会从断点继续
+# 返回本次处理的记录数
+def rerender_model(model, chunk_size=500, workers=None, checkpoint_path=None,
+             echo=print):
+    table = model.__table__
+    with_abstract = 'abstract' in table.c
+    checkpoint = load_checkpoint(checkpoint_path)
+    last_id = checkpoint.get(table.name, 0)
+    query = db.session.query(model.id, model.body)\
+        .filter(model.body.isnot(None))
+    total = query.filter(model.id > last_id).count()
+    done = 0
+    stmt = table.update().where(table.c.id == db.bindparam('_id'))
+    workers = workers or os.cpu_count() or 1
+    # 每个子进程一次处理的记录数
+    batch = max(1, chunk_size // (workers * 4))
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            rows = query.filter(model.id > last_id).order_by(model.id)\
+                .limit(chunk_size).all()
+            if not rows:
+                break
+            rows = [tuple(row) for row in rows]
+            batches = [rows[i:i + batch] for i in range(0, len(rows), batch)]
+            params = []
+            for results in pool.map(render_rows, batches,
+                                    [model.allowed_tags] * len(batches),
+                                    [with_abstract] * len(batches)):
+                params.extend(results)
+            db.session.execute(stmt, params)
+            db.session.commit()
+            last_id = rows[-1][0]
+            done += len(rows)
+            checkpoint[table.name] = last_id
+            save_checkpoint(checkpoint_path, checkpoint)
+            echo('{}: {}/{}'.format(table.name, done, total))
+    # 处理完后保留该表的断点，后面的表中断后再次运行时不必重新处理这张表，
+    # 断点文件由rerender_models在所有表都处理完后删除
+    return done
+
+
+# 依次重新渲染models中的每个模型，全部完成后删除断点文件
+# 返回[(表名, 本次处理的记录数)]
+def rerender_models(models, chunk_size=500, workers=None, checkpoint_path=None,
+                    echo=print):
+    counts = [(model.__tablename__,
+               rerender_model(model, chunk_size, workers, checkpoint_path, echo))
+              for model in models]
+    save_checkpoint(checkpoint_path, {})
+    return counts
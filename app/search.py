@@ -0,0 +1,187 @@
+import re
+import sqlite3
+import threading
+from flask import current_app
+from markupsafe import Markup, escape
+from .render import TextExtractor
+
+
+# 分词：连续的中日韩汉字切成相邻两字一组（二元切分），单个汉字单独成词；
+# 英文字母和数字按单词切分并转为小写，其余字符（标点、空白）作为分隔符
+_token_re = re.compile(r'([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)|([0-9a-z]+)')
+
+
+def _bigrams(run):
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+# 把文本切分成词，词之间用空格分隔后存入全文索引
+def tokenize(text):
+    tokens = []
+    for run, word in _token_re.findall((text or '').lower()):
+        tokens.extend(_bigrams(run) if run else [word])
+    return tokens
+
+
+# 文本中的每个汉字，单独存入索引，用于搜索单个汉字
+# 二元词中的字在词尾时无法由前缀查询找到，所以另存一份单字
+def characters(text):
+    return [char for run, _ in _token_re.findall((text or '').lower())
+            for char in run]
+
+
+# 把搜索词转换为FTS5查询表达式，各部分之间为AND关系
+# 连续汉字的二元词组成短语，要求在文章中相邻出现，即匹配原文中连续的这段文字；
+# 单个汉字匹配单字列中的这个字
+def make_query(q):
+    terms = []
+    for run, word in _token_re.findall(q.lower()):
+        if word:
+            terms.append('"{}"'.format(word))
+        else:
+            terms.append('"{}"'.format(' '.join(_bigrams(run))))
+    return ' '.join(terms)
+
+
+# 在文本中高亮搜索词，返回转义后的html
+def highlight(text, q):
+    text = text or ''
+    terms = {run or word for run, word in _token_re.findall(q.lower())}
+    if not terms:
+        return escape(text)
+    pattern = re.compile('|'.join(re.escape(term) for term in
+                                  sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE)
+    parts = []
+    last = 0
+    for m in pattern.finditer(text):
+        parts.append(escape(text[last:m.start()]))
+        parts.append(Markup('<mark>{}</mark>').format(m.group()))
+        last = m.end()
+    parts.append(escape(text[last:]))
+    return Markup('').join(parts)
+
+
+# 提取文章html的全部纯文本
+def html_text(html):
+    parser = TextExtractor()
+    parser.feed(html or '')
+    parser.close()
+    return parser.text
+
+
+# 文章全文索引，保存在单独的SQLite数据库中（FTS5虚拟表，rowid为文章id）
+# 标题和正文先由tokenize分词，索引中只存分好的词，汉字的单字另存在title_chars、body_chars列；
+# 按BM25排序，标题中的词权重更高
+class SearchIndex:
+    columns = ('title', 'body', 'title_chars', 'body_chars')
+    # BM25中各列的权重
+    weights = (5.0, 1.0, 5.0, 1.0)
+    _insert = 'INSERT INTO post_index (rowid, {}) VALUES (?, ?, ?, ?, ?)'.format(
+        ', '.join(columns))
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None,
+                                     check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        # 旧版本的索引列不同时删除重建，需要再用flask reindex写入文章
+        columns = tuple(row[1] for row in self._conn.execute(
+            'PRAGMA table_info(post_index)'))
+        if columns and columns != self.columns:
+            self._conn.execute('DROP TABLE post_index')
+        self._conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS post_index '
+                           'USING fts5({})'.format(', '.join(self.columns)))
+
+    @staticmethod
+    def _row(post_id, title, html):
+        body = html_text(html)
+        return (post_id, ' '.join(tokenize(title)), ' '.join(tokenize(body)),
+                ' '.join(characters(title)), ' '.join(characters(body)))
+
+    # 在一个事务中执行func(cursor)
+    def _write(self, func):
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                func(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+
+    # 更新索引，docs为{文章id: (标题, 正文html)}，值为None时从索引中删除该文章
+    def update(self, docs):
+        def write(cursor):
+            cursor.executemany('DELETE FROM post_index WHERE rowid = ?',
+                               [(post_id,) for post_id in docs])
+            cursor.executemany(self._insert, [
+                self._row(post_id, *doc) for post_id, doc in docs.items()
+                if doc is not None])
+        self._write(write)
+
+    # 清空后重建索引，rows为(文章id, 标题, 正文html)，返回写入的文章数
+    # 重建在一个事务中完成，期间的搜索仍使用旧索引
+    def rebuild(self, rows):
+        count = 0
+
+        def write(cursor):
+            nonlocal count
+            cursor.execute('DELETE FROM post_index')
+            for row in rows:
+                cursor.execute(self._insert, self._row(*row))
+                count += 1
+            cursor.execute("INSERT INTO post_index (post_index) VALUES ('optimize')")
+        self._write(write)
+        return count
+
+    # 搜索文章，返回按相关度排序的一页文章id和匹配的文章总数
+    def search(self, q, offset, limit):
+        query = make_query(q)
+        if not query:
+            return [], 0
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                'SELECT rowid FROM post_index WHERE post_index MATCH ? '
+                'ORDER BY bm25(post_index, ?, ?, ?, ?), rowid DESC '
+                'LIMIT ? OFFSET ?',
+                (query,) + self.weights + (limit, offset))]
+            total = self._conn.execute(
+                'SELECT count(*) FROM post_index WHERE post_index MATCH ?',
+                (query,)).fetchone()[0]
+        return ids, total
+
+
+# 搜索索引，每个应用一份，保存在app.extensions中
+def search_index():
+    index = current_app.extensions.get('search_index')
+    if index is None:
+        index = current_app.extensions.setdefault(
+            'search_index', SearchIndex(current_app.config['SEARCH_INDEX_PATH']))
+    return index
+
+
+# 事务提交后更新搜索索引
+# 写入失败不影响已提交的数据，索引可以用flask reindex命令重建
+def update_index(docs):
+    try:
+        search_index().update(docs)
+    except sqlite3.Error:
+        current_app.logger.exception('更新搜索索引失败')
+
+
+# 搜索结果按页码分页（结果按相关度排序，不能按游标翻页）
+class SearchPagination:
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.total = total
+        self.pages = max(1, (total + per_page - 1) // per_page)
+        self.has_prev = page > 1
+        self.has_next = page < self.pages
+        self.prev_num = page - 1
+        self.next_num = page + 1
@@ -0,0 +1,7 @@
+# 生成忽略重复记录的INSERT语句
+# MySQL为INSERT IGNORE，SQLite为INSERT OR IGNORE
+# 依靠唯一索引忽略重复记录，省去插入前先查询的一次往返，也避免并发请求插入重复记录
+def insert_ignore(table):
+    return table.insert()\
+        .prefix_with('IGNORE', dialect='mysql')\
+        .prefix_with('OR IGNORE', dialect='sqlite')
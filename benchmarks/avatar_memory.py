@@ -0,0 +1,121 @@
+# 头像上传内存测试：每种情况在单独的子进程中运行，比较处理一张上传图片前后进程的峰值内存（RSS）
+# 原方式：整个文件读入内存后按原尺寸解码、裁剪、缩放（原create_avatar的做法）
+# 新方式：分块写入临时文件，检查文件头后用draft()缩小解码（save_avatar的做法）
+# 运行方法：python benchmarks/avatar_memory.py（需要Linux的/proc文件系统）
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import zlib
+from io import BytesIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+
+# 读取/proc/self/status中的内存数据（MB），只支持Linux
+def proc_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024
+    raise KeyError(key)
+
+
+# 把峰值内存重置为当前占用的内存，返回当前占用的内存（MB）
+def reset_peak():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return proc_status('VmRSS')
+
+
+# 重置以来的峰值内存（MB）
+def peak_rss():
+    return proc_status('VmHWM')
+
+
+# 只有文件头的PNG，声明的尺寸为width x height（解压炸弹）
+def make_png_bomb(width, height):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data))
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + \
+        chunk(b'IDAT', zlib.compress(b'')) + chunk(b'IEND', b'')
+
+
+def run_old(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    im = Image.open(BytesIO(data)).convert('RGB')
+    w, h = im.size
+    half = min(w, h) // 2
+    im = im.crop((w // 2 - half, h // 2 - half, w // 2 + half, h // 2 + half))
+    im.resize((128, 128))
+    im.resize((50, 50))
+
+
+def run_new(path, dest):
+    from app import create_app
+    from app.image import save_avatar, AvatarError
+    app = create_app('testing')
+    app.config['AVATAR_DEST'] = dest
+    with app.app_context():
+        # 只生成头像文件，不更新数据库
+        import app.image as image
+        image.update_avatar = lambda user_id, source, digest: \
+            image.write_avatar(source, digest)
+        user = type('User', (), {'id': 1})()
+        with open(path, 'rb') as f:
+            try:
+                save_avatar(user, FileStorage(f, filename=os.path.basename(path)))
+            except AvatarError as e:
+                print('已拒绝：{}'.format(e), file=sys.stderr)
+
+
+# 子进程：运行一种情况，输出峰值内存比运行前占用内存增加的量
+def child(case, path, dest):
+    # 先载入应用，排除导入模块占用的内存
+    from app import create_app
+    create_app('testing')
+    base = reset_peak()
+    if case == 'old':
+        run_old(path)
+    else:
+        run_new(path, dest)
+    print('{:.1f}'.format(peak_rss() - base))
+
+
+def main():
+    tmp = tempfile.mkdtemp()
+    files = {}
+    path = os.path.join(tmp, 'photo.jpg')
+    Image.new('RGB', (6000, 4000), (90, 160, 210)).save(path, 'JPEG')
+    files['6000x4000 JPEG'] = path
+    path = os.path.join(tmp, 'bomb.png')
+    with open(path, 'wb') as f:
+        f.write(make_png_bomb(30000, 30000))
+    files['30000x30000 PNG炸弹'] = path
+    print('{:<22} {:>14} {:>14}'.format('图片', '原方式(MB)', '新方式(MB)'))
+    for name, path in files.items():
+        results = []
+        for case in ('old', 'new'):
+            if case == 'old' and 'PNG' in name:
+                # 原方式解码解压炸弹会耗尽内存，不实际运行
+                results.append('-')
+                continue
+            output = subprocess.run(
+                [sys.executable, __file__, case, path, tmp],
+                capture_output=True, text=True, check=True)
+            results.append(output.stdout.strip())
+        print('{:<22} {:>16} {:>16}'.format(name, *results))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        child(*sys.argv[1:])
+    else:
+        main()
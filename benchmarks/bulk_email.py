@@ -0,0 +1,91 @@
+# 批量邮件发送吞吐量测试：在本机启动一个只接收不投递的SMTP服务器，
+# 比较逐封渲染、逐封建立连接（原send_email的发送方式）与send_bulk_email的每秒发送封数
+# 运行方法：python benchmarks/bulk_email.py
+import os
+import socketserver
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from flask import render_template
+from flask_mail import Message
+from app import create_app, mail
+from app.email import send_bulk_email
+
+
+# 最简单的SMTP服务器，接受所有邮件后直接丢弃
+class SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost ready')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    self.reply('250 OK')
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                in_data = True
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# 逐封渲染模板、逐封建立SMTP连接发送
+def send_one_by_one(app, users, content):
+    for user in users:
+        msg = Message(app.config['MAIL_SUBJECT_PREFIX'] + ' 公告',
+                      sender=app.config['MAIL_SENDER'], recipients=[user.email])
+        msg.body = render_template('mail/announcement.txt', user=user,
+                                   content=content)
+        msg.html = render_template('mail/announcement.html', user=user,
+                                   content=content)
+        mail.send(msg)
+
+
+def main():
+    server = SinkServer(('127.0.0.1', 0), SinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app = create_app('testing')
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=server.server_address[1],
+                      MAIL_USE_SSL=False, MAIL_USE_TLS=False,
+                      MAIL_USERNAME=None, MAIL_PASSWORD=None,
+                      MAIL_SUPPRESS_SEND=False, TESTING=False)
+    mail.init_app(app)
+    content = '蜜蜂博客将于本周六凌晨进行系统维护。' * 20
+    print('{:>8} {:>16} {:>16}'.format('封数', '逐封(封/秒)', '批量(封/秒)'))
+    with app.app_context():
+        for n in (50, 200, 1000):
+            users = [SimpleNamespace(email='u{}@example.com'.format(i),
+                                     username='user{}'.format(i))
+                     for i in range(n)]
+            start = time.perf_counter()
+            send_one_by_one(app, users, content)
+            single = n / (time.perf_counter() - start)
+            start = time.perf_counter()
+            send_bulk_email([user.email for user in users], '公告',
+                            'mail/announcement',
+                            {user.email: {'user': user} for user in users},
+                            content=content)
+            bulk = n / (time.perf_counter() - start)
+            print('{:>10} {:>18.0f} {:>18.0f}'.format(n, single, bulk))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
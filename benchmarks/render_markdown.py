@@ -0,0 +1,43 @@
+# Markdown渲染耗时测试：比较不使用缓存和使用渲染缓存时，每KB文本的平均渲染时间
+# 运行方法：python benchmarks/render_markdown.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.models import Post
+from app.render import RenderCache, content_hash, render_markdown
+
+
+# 生成约size_kb KB的Markdown文本
+def make_text(size_kb):
+    paragraph = ('## 小标题\n\n蜜蜂博客是一个**学习**、*创作*、交流的平台，'
+                 '访问 https://example.com 了解更多。\n\n'
+                 '- 列表项一\n- 列表项二\n\n```\ncode block\n```\n\n')
+    text = ''
+    while len(text.encode('utf-8')) < size_kb * 1024:
+        text += paragraph
+    return text
+
+
+def main():
+    number = 20
+    print('{:>8} {:>16} {:>16}'.format('大小', '不缓存(ms/KB)', '缓存(ms/KB)'))
+    for size_kb in (1, 4, 16, 64):
+        text = make_text(size_kb)
+        kb = len(text.encode('utf-8')) / 1024
+        plain = timeit.timeit(
+            lambda: render_markdown(text, Post.allowed_tags), number=number)
+        cache = RenderCache()
+        cache.render(text, Post.allowed_tags)
+        # 使用缓存时仍需计算文本的hash值
+        cached = timeit.timeit(
+            lambda: cache.render(text, Post.allowed_tags, content_hash(text)),
+            number=number)
+        print('{:>6}KB {:>16.4f} {:>16.4f}'.format(
+            size_kb, plain / number / kb * 1000, cached / number / kb * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,12 +26,70 @@ class Config:
     AVATAR_DEST = os.path.abspath(os.path.join(os.getcwd(),"app/static/avatar"))
     # 上传头像类型限制
     ALLOWED_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
+    # 生成的头像尺寸 {名称: 边长}，big、small分别为大头像、小头像
+    AVATAR_SIZES = {'big': 128, 'small': 50}
+    # 是否另存一份WebP格式的头像
+    AVATAR_WEBP = True
+    # 头像的JPEG、WebP压缩质量
+    AVATAR_QUALITY = 85
+    # 处理头像的后台线程数，为0时在请求中直接处理
+    AVATAR_WORKERS = 2
+    # 上传头像文件的最大字节数
+    AVATAR_MAX_SIZE = 4 * 1024 * 1024
+    # 上传头像的最大像素数（宽 x 高），由文件头检查，防止解码超大图片耗尽内存
+    AVATAR_MAX_PIXELS = 4000 * 4000
+    # 清理头像时跳过最近多少秒内写入的文件（可能正被其他进程使用、尚未提交）
+    AVATAR_GC_GRACE = 300
+    # 小于此字节数的小头像在列表页中内嵌为data URI，为0时总是使用静态文件地址
+    AVATAR_INLINE_MAX_SIZE = 4096
+    # 请求体的最大字节数，超过时直接返回413，不再读取请求体
+    MAX_CONTENT_LENGTH = 5 * 1024 * 1024
+    # 文章搜索索引（SQLite全文索引）的路径
+    SEARCH_INDEX_PATH = os.path.abspath(os.path.join(os.getcwd(), 'search.db'))
     # 每页显示的文章数量
     POSTS_PER_PAGE = 10
     # 每页显示的粉丝数量
     FOLLOWERS_PER_PAGE = 20
     # 每页显示的评论数量
     COMMENTS_PER_PAGE = 10
+    # 分页总数的缓存时间（秒）
+    PAGINATION_COUNT_TTL = 60
+    # 缓存的分页总数的最大个数
+    PAGINATION_COUNT_CACHE_SIZE = 256
+    # 上次登陆时间的合并窗口（秒），窗口内的重复访问不更新上次登陆时间
+    LAST_LOGIN_INTERVAL = 300
+    # 缓冲的上次登陆时间写入数据库的间隔（秒）
+    LAST_LOGIN_FLUSH_INTERVAL = 60
+    # 写入缓冲的阅读记录的间隔（秒），由后台线程和请求结束时写入；
+    # 为0时不启动后台线程，每个请求结束时写入
+    BUFFER_FLUSH_INTERVAL = 10
+    # 匿名用户页面缓存类型：simple（进程内LRU）、filesystem、redis，为None时不缓存
+    RESPONSE_CACHE_TYPE = os.environ.get('RESPONSE_CACHE_TYPE', 'simple')
+    # 页面缓存时间（秒）
+    RESPONSE_CACHE_TIMEOUT = 60
+    # 进程内缓存的最大页面数
+    RESPONSE_CACHE_SIZE = 512
+    # 文件系统缓存目录
+    RESPONSE_CACHE_DIR = os.path.abspath(os.path.join(os.getcwd(), 'cache'))
+    # Redis缓存地址
+    RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL',
+                                              'redis://localhost:6379/0')
+    # 登陆用户缓存时间（秒），为0时每次请求都从数据库载入用户
+    USER_CACHE_TIMEOUT = 30
+    # 进程内缓存的最大用户数
+    USER_CACHE_SIZE = 1024
+    # 发送邮件的后台线程数，为0时不启动后台线程（用flask sendmail命令发送）
+    MAIL_QUEUE_WORKERS = 2
+    # 每个线程每次领取的邮件数
+    MAIL_QUEUE_BATCH_SIZE = 50
+    # 队列为空时检查新邮件的间隔（秒）
+    MAIL_QUEUE_POLL_INTERVAL = 5
+    # 最大尝试次数，超过后标记为发送失败
+    MAIL_QUEUE_MAX_ATTEMPTS = 5
+    # 第一次重试的延迟（秒），之后每次加倍
+    MAIL_QUEUE_RETRY_DELAY = 60
+    # 领取的邮件超过此时间（秒）仍未发送完成时可被重新领取
+    MAIL_QUEUE_LOCK_TIMEOUT = 300
 
     @staticmethod
     def init_app(app):
@@ -47,6 +105,11 @@ class DevelopmentConfig(Config):
 # 测试环境配置
 class TestingConfig(Config):
     TESTING = True
+    BUFFER_FLUSH_INTERVAL = 0
+    RESPONSE_CACHE_TYPE = None
+    MAIL_QUEUE_WORKERS = 0
+    AVATAR_WORKERS = 0
+    SEARCH_INDEX_PATH = ':memory:'
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI')
 
 
@@ -0,0 +1,32 @@
+"""users加入粉丝数_关注数
+
+Revision ID: 3d7b9e2c5f16
+Revises: f31c6a8d2b47
+Create Date: 2026-10-18 18:42:26.905317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d7b9e2c5f16'
+down_revision = 'f31c6a8d2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('followers_count', sa.Integer(), nullable=True))
+    op.add_column('users', sa.Column('following_count', sa.Integer(), nullable=True))
+    # 按关注表回填已有用户的计数
+    op.execute('UPDATE users SET '
+               'followers_count = (SELECT COUNT(*) FROM follows '
+               'WHERE follows.followed_id = users.id), '
+               'following_count = (SELECT COUNT(*) FROM follows '
+               'WHERE follows.follower_id = users.id)')
+
+
+def downgrade():
+    op.drop_column('users', 'following_count')
+    op.drop_column('users', 'followers_count')
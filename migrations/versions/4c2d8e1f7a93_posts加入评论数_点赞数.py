@@ -0,0 +1,32 @@
+"""posts加入评论数_点赞数
+
+Revision ID: 4c2d8e1f7a93
+Revises: 2dcbaba64d00
+Create Date: 2026-10-18 10:12:07.318254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c2d8e1f7a93'
+down_revision = '2dcbaba64d00'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('comments_count', sa.Integer(), nullable=True))
+    op.add_column('posts', sa.Column('likes_count', sa.Integer(), nullable=True))
+    # 按评论表、点赞表回填已有文章的计数
+    op.execute('UPDATE posts SET '
+               'comments_count = (SELECT COUNT(*) FROM comments '
+               'WHERE comments.post_id = posts.id), '
+               'likes_count = (SELECT COUNT(*) FROM post_likes '
+               'WHERE post_likes.post_id = posts.id)')
+
+
+def downgrade():
+    op.drop_column('posts', 'likes_count')
+    op.drop_column('posts', 'comments_count')
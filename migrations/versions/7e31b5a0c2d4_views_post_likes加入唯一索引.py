@@ -0,0 +1,42 @@
+"""views_post_likes加入唯一索引
+
+Revision ID: 7e31b5a0c2d4
+Revises: 4c2d8e1f7a93
+Create Date: 2026-10-18 11:03:45.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e31b5a0c2d4'
+down_revision = '4c2d8e1f7a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 删除并发请求产生的重复记录（保留id最小的一条），否则无法建立唯一索引
+    # 子查询再包一层派生表，避免MySQL不能在子查询中引用被删除表的限制
+    op.execute('DELETE FROM views WHERE id NOT IN (SELECT id FROM '
+               '(SELECT MIN(id) AS id FROM views '
+               'GROUP BY viewer_id, post_id) AS keep_views)')
+    op.execute('DELETE FROM post_likes WHERE id NOT IN (SELECT id FROM '
+               '(SELECT MIN(id) AS id FROM post_likes '
+               'GROUP BY liker_id, post_id) AS keep_likes)')
+    op.create_index('ix_views_viewer_id_post_id', 'views',
+                    ['viewer_id', 'post_id'], unique=True)
+    op.create_index('ix_post_likes_liker_id_post_id', 'post_likes',
+                    ['liker_id', 'post_id'], unique=True)
+    # 删除重复记录后重新统计阅读数和点赞数
+    op.execute('UPDATE posts SET '
+               'views_count = (SELECT COUNT(*) FROM views '
+               'WHERE views.post_id = posts.id), '
+               'likes_count = (SELECT COUNT(*) FROM post_likes '
+               'WHERE post_likes.post_id = posts.id)')
+
+
+def downgrade():
+    op.drop_index('ix_post_likes_liker_id_post_id', table_name='post_likes')
+    op.drop_index('ix_views_viewer_id_post_id', table_name='views')
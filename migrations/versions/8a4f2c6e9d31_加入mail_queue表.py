@@ -0,0 +1,41 @@
+"""加入mail_queue表
+
+Revision ID: 8a4f2c6e9d31
+Revises: 3d7b9e2c5f16
+Create Date: 2026-10-18 19:20:48.263511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4f2c6e9d31'
+down_revision = '3d7b9e2c5f16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mail_queue',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sender', sa.String(length=128), nullable=True),
+    sa.Column('recipients', sa.Text(), nullable=True),
+    sa.Column('subject', sa.String(length=128), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('status', sa.String(length=16), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('next_attempt', sa.DateTime(), nullable=True),
+    sa.Column('claim', sa.String(length=32), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_mail_queue_status_next_attempt', 'mail_queue',
+                    ['status', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_mail_queue_status_next_attempt', table_name='mail_queue')
+    op.drop_table('mail_queue')
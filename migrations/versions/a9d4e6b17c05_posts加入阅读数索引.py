@@ -0,0 +1,27 @@
+"""posts加入阅读数索引
+
+Revision ID: a9d4e6b17c05
+Revises: 7e31b5a0c2d4
+Create Date: 2026-10-18 13:27:51.640832
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d4e6b17c05'
+down_revision = '7e31b5a0c2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 阅读数为NULL时无法参与游标比较，统一改为0
+    op.execute('UPDATE posts SET views_count = 0 WHERE views_count IS NULL')
+    op.create_index('ix_posts_views_count_id', 'posts',
+                    ['views_count', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_posts_views_count_id', table_name='posts')
@@ -0,0 +1,43 @@
+"""加入timelines表
+
+Revision ID: c5f0a3d92e18
+Revises: a9d4e6b17c05
+Create Date: 2026-10-18 15:02:19.477210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f0a3d92e18'
+down_revision = 'a9d4e6b17c05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=True),
+    sa.Column('ctime', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['author_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timelines_user_id_ctime_post_id', 'timelines',
+                    ['user_id', 'ctime', 'post_id'], unique=False)
+    op.create_index('ix_timelines_user_id_author_id', 'timelines',
+                    ['user_id', 'author_id'], unique=False)
+    # 按已有的关注关系回填关注动态
+    op.execute('INSERT INTO timelines (user_id, post_id, author_id, ctime) '
+               'SELECT follows.follower_id, posts.id, posts.author_id, posts.ctime '
+               'FROM follows JOIN posts ON posts.author_id = follows.followed_id')
+
+
+def downgrade():
+    op.drop_index('ix_timelines_user_id_author_id', table_name='timelines')
+    op.drop_index('ix_timelines_user_id_ctime_post_id', table_name='timelines')
+    op.drop_table('timelines')
@@ -0,0 +1,27 @@
+"""posts_comments加入body_hash
+
+Revision ID: e82b7d4f1a60
+Revises: c5f0a3d92e18
+Create Date: 2026-10-18 16:40:33.115862
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e82b7d4f1a60'
+down_revision = 'c5f0a3d92e18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 已有记录的body_hash为NULL，下次修改时会重新渲染一次并写入hash值
+    op.add_column('comments', sa.Column('body_hash', sa.String(length=40), nullable=True))
+    op.add_column('posts', sa.Column('body_hash', sa.String(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('posts', 'body_hash')
+    op.drop_column('comments', 'body_hash')
@@ -0,0 +1,33 @@
+"""follows加入关注时间索引
+
+Revision ID: f31c6a8d2b47
+Revises: e82b7d4f1a60
+Create Date: 2026-10-18 18:05:12.480173
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f31c6a8d2b47'
+down_revision = 'e82b7d4f1a60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 关注时间为NULL时无法参与游标比较，以关注者的注册时间代替
+    op.execute('UPDATE follows SET timestamp = '
+               '(SELECT member_since FROM users '
+               'WHERE users.id = follows.follower_id) '
+               'WHERE timestamp IS NULL')
+    op.create_index('ix_follows_followed_id_timestamp', 'follows',
+                    ['followed_id', 'timestamp', 'follower_id'], unique=False)
+    op.create_index('ix_follows_follower_id_timestamp', 'follows',
+                    ['follower_id', 'timestamp', 'followed_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_follows_follower_id_timestamp', table_name='follows')
+    op.drop_index('ix_follows_followed_id_timestamp', table_name='follows')
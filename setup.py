@@ -1,7 +1,12 @@
 import os
+import click
 from flask_migrate import Migrate, upgrade
 from app import create_app, db
-from app.models import Role, User
+from app.models import Role, User, Post, Comment, Timeline
+from app.buffer import flush_buffers
+from app.email import mail_queue, send_bulk_email, BulkEmailError
+from app.image import gc_avatars
+from app.rerender import rerender_models
 
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
@@ -11,7 +16,7 @@ migrate = Migrate(app, db)
 # 配置shell命令字典
 @app.shell_context_processor
 def make_shell_context():
-    return dict(db=db, User=User, Role=Role)
+    return dict(db=db, User=User, Role=Role, Post=Post)
 
 
 # 配置单元测试命令
@@ -34,4 +39,97 @@ def deploy():
     upgrade()
 
     # 创建或更新用户角色
-    Role.insert_roles()
\ No newline at end of file
+    Role.insert_roles()
+
+
+# 配置重新渲染命令
+@app.cli.command()
+@click.option('--chunk-size', default=500, help='每批读取的记录数')
+@click.option('--workers', default=None, type=int, help='渲染进程数，默认为CPU核数')
+@click.option('--checkpoint', default='rerender_checkpoint.json',
+              help='断点文件路径')
+@click.option('--restart', is_flag=True, help='忽略断点，从头开始')
+def rerender(chunk_size, workers, checkpoint, restart):
+    """重新渲染所有文章和评论的body_html，并重新生成文章摘要"""
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    for name, count in rerender_models((Post, Comment), chunk_size, workers,
+                                       checkpoint):
+        print('{}: 已重新渲染{}条记录'.format(name, count))
+
+
+# 配置修正文章、用户计数命令
+@app.cli.command()
+def recount():
+    """重新统计文章的评论数、点赞数和用户的粉丝数、关注数"""
+    count = Post.update_counts()
+    print('已修正{}篇文章的计数'.format(count))
+    count = User.update_follow_counts()
+    print('已修正{}个用户的计数'.format(count))
+
+
+# 配置重建关注动态命令
+@app.cli.command()
+def timeline():
+    """按关注关系重建所有用户的关注动态"""
+    count = Timeline.rebuild()
+    print('已写入{}条关注动态'.format(count))
+
+
+# 配置重建搜索索引命令
+@app.cli.command()
+def reindex():
+    """按文章表重建文章搜索索引"""
+    count = Post.reindex()
+    print('已索引{}篇文章'.format(count))
+
+
+# 配置写入缓冲区命令
+@app.cli.command()
+def flush():
+    """把缓冲的阅读记录和上次登陆时间写入数据库"""
+    views, logins = flush_buffers()
+    print('已写入{}条阅读记录，{}个用户的上次登陆时间'.format(views, logins))
+
+
+# 配置发送邮件队列命令
+@app.cli.command()
+def sendmail():
+    """发送邮件队列中所有到期的邮件"""
+    count = mail_queue.process()
+    print('已发送{}封邮件'.format(count))
+
+
+# 配置发送公告邮件命令
+@app.cli.command()
+@click.argument('subject')
+@click.argument('content')
+@click.option('--start', default=None, help='从这个邮箱的用户开始发送（继续中断的发送）')
+def announce(subject, content, start):
+    """给所有已确认注册的用户发送公告邮件"""
+    query = User.query.filter_by(confirmed=True)
+    if start:
+        # 从中断时出错的收件人继续发送
+        first = User.query.filter_by(email=start).first()
+        if first is None:
+            raise click.ClickException('没有邮箱为{}的用户'.format(start))
+        query = query.filter(User.id >= first.id)
+    users = query.order_by(User.id)\
+        .options(db.load_only(User.email, User.username)).all()
+    try:
+        count = send_bulk_email([user.email for user in users], subject,
+                                'mail/announcement',
+                                {user.email: {'user': user} for user in users},
+                                content=content)
+    except BulkEmailError as e:
+        raise click.ClickException(
+            '{}，可以用 --start {} 继续发送'.format(e, e.recipient))
+    print('已发送{}封公告邮件'.format(count))
+
+
+# 配置清理头像命令
+@app.cli.command()
+def avatars():
+    """删除不再被任何用户使用的头像文件"""
+    count = gc_avatars()
+    print('已删除{}个头像文件'.format(count))
@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+from app import create_app, db, response_cache
+from app.cache import SimpleCache, FileSystemCache
+from app.models import Role
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['RESPONSE_CACHE_TYPE'] = 'simple'
+        response_cache.init_app(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # 测试进程内缓存按LRU淘汰、按时间过期
+    def test_simple_cache(self):
+        cache = SimpleCache(maxsize=2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        cache.set('d', 4, -1)
+        self.assertIsNone(cache.get('d'))
+
+    # 测试文件系统缓存
+    def test_filesystem_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = FileSystemCache(tmp)
+            cache.set('a', (b'data', 200, []), 60)
+            self.assertEqual(cache.get('a'), (b'data', 200, []))
+            cache.clear()
+            self.assertIsNone(cache.get('a'))
+
+    # 测试匿名用户的页面第二次请求命中缓存，清除缓存后重新渲染
+    def test_anonymous_page_cached(self):
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response_cache.stats()['hits'], 1)
+        response_cache.clear()
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+    # 测试缓存命中时If-None-Match与缓存页面的ETag匹配则返回304
+    def test_cached_page_not_modified(self):
+        etag = self.client.get('/').headers['ETag']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
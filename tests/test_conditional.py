@@ -0,0 +1,64 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        u = User(email='john@example.com', username='john', password='cat')
+        self.post = Post(title='title', body='body', author=u)
+        db.session.add_all([u, self.post])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # 测试文章页ETag匹配时返回304，新增评论后ETag改变
+    def test_post_etag(self):
+        url = '/post/{}'.format(self.post.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertIsNone(response.last_modified)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        c = Comment(body='comment', post=self.post,
+                    author_id=self.post.author_id)
+        self.post.comments_count = 1
+        db.session.add(c)
+        db.session.commit()
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 测试文章页只用ETag验证，编辑文章后只带If-Modified-Since的请求也得到新页面
+    def test_post_ignores_if_modified_since(self):
+        url = '/post/{}'.format(self.post.id)
+        later = datetime.utcnow() + timedelta(minutes=1)
+        self.post.body = 'edited body'
+        db.session.commit()
+        response = self.client.get(url, headers={
+            'If-Modified-Since': later.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('edited body', response.get_data(as_text=True))
+
+    # 测试主页列表的ETag
+    def test_index_etag(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.post.likes_count = 1
+        db.session.commit()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,189 @@
+import smtplib
+import unittest
+from datetime import datetime
+from unittest import mock
+from flask import render_template
+from flask_mail import Connection, Message
+from app import create_app, db, mail
+from app.email import MailQueue, send_email, send_bulk_email, BulkEmailError
+from app.models import User, Role, MailJob
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.queue = MailQueue()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def put(self, n):
+        for i in range(n):
+            self.queue.put(Message('subject', sender='admin@example.com',
+                                   recipients=['u{}@example.com'.format(i)],
+                                   body='body', html='<p>html</p>'))
+
+    # 测试send_email只写入队列，由process批量发送后删除
+    def test_send_email_queued(self):
+        with self.app.test_request_context(), \
+                mock.patch('app.email.mail_queue', self.queue):
+            u = User(email='john@example.com', username='john')
+            send_email(u.email, '确认注册信息', 'auth/email/confirm',
+                       user=u, token='token')
+        self.assertEqual(MailJob.query.count(), 1)
+        self.assertEqual(self.queue.stats()['pending'], 1)
+        with mail.record_messages() as outbox:
+            self.assertEqual(self.queue.process(), 1)
+        self.assertEqual(outbox[0].recipients, ['john@example.com'])
+        self.assertIn('token', outbox[0].body)
+        self.assertEqual(MailJob.query.count(), 0)
+
+    # 测试多批邮件使用同一个SMTP连接发送
+    def test_batches_share_connection(self):
+        self.put(5)
+        with mock.patch.object(mail, 'connect', wraps=mail.connect) as connect:
+            with mail.record_messages() as outbox:
+                self.assertEqual(self.queue.process(batch_size=2), 5)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(outbox), 5)
+        self.assertEqual(self.queue.stats()['sent'], 5)
+
+    # 发送给指定收件人时抛出error，其余邮件正常发送
+    @staticmethod
+    def fail_for(recipient, error):
+        send = Connection.send
+
+        def fake_send(conn, message, envelope_from=None):
+            if recipient in message.recipients:
+                raise error
+            return send(conn, message, envelope_from)
+        return mock.patch.object(Connection, 'send', autospec=True,
+                                 side_effect=fake_send)
+
+    # 测试被拒收的邮件推迟重试，超过最大次数后标记为失败
+    def test_retry_with_backoff(self):
+        self.app.config['MAIL_QUEUE_MAX_ATTEMPTS'] = 2
+        self.put(1)
+        error = smtplib.SMTPDataError(554, 'rejected')
+        with self.fail_for('u0@example.com', error):
+            self.assertEqual(self.queue.process(), 0)
+        job = MailJob.query.one()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertGreater(job.next_attempt, datetime.utcnow())
+        # 未到重试时间时不会被领取
+        self.assertEqual(self.queue.process(), 0)
+        job.next_attempt = datetime.utcnow()
+        db.session.commit()
+        with self.fail_for('u0@example.com', error):
+            self.queue.process()
+        db.session.expire_all()
+        job = MailJob.query.one()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertIn('rejected', job.last_error)
+        stats = self.queue.stats()
+        self.assertEqual((stats['failed'], stats['retried'], stats['abandoned']),
+                         (1, 1, 1))
+
+    # 测试一个收件人被拒收时只推迟这一封，同批的其他邮件照常发送
+    def test_refused_recipient(self):
+        self.put(3)
+        error = smtplib.SMTPRecipientsRefused({'u1@example.com': (550, b'no')})
+        with self.fail_for('u1@example.com', error), \
+                mail.record_messages() as outbox:
+            self.assertEqual(self.queue.process(), 2)
+        self.assertEqual(len(outbox), 2)
+        job = MailJob.query.one()
+        self.assertEqual((job.recipients, job.status, job.attempts),
+                         ('u1@example.com', 'pending', 1))
+
+    # 测试连接中断时尚未发送的邮件放回队列，不计入尝试次数
+    def test_disconnect_releases(self):
+        self.put(3)
+        error = smtplib.SMTPServerDisconnected('closed')
+        with self.fail_for('u1@example.com', error), \
+                mail.record_messages() as outbox:
+            self.assertEqual(self.queue.process(), 1)
+        self.assertEqual(len(outbox), 1)
+        jobs = MailJob.query.order_by(MailJob.id).all()
+        self.assertEqual([(job.recipients, job.status, job.attempts, job.claim)
+                          for job in jobs],
+                         [('u1@example.com', 'pending', 0, None),
+                          ('u2@example.com', 'pending', 0, None)])
+        self.assertLessEqual(jobs[0].next_attempt, datetime.utcnow())
+
+    # 测试队列为空时不连接SMTP服务器
+    def test_idle_does_not_connect(self):
+        with mock.patch.object(mail, 'connect') as connect:
+            self.assertEqual(self.queue.process(), 0)
+        connect.assert_not_called()
+
+    # 测试无法组装的邮件计入尝试次数并推迟重试，不影响同批的其他邮件
+    def test_bad_message_retried(self):
+        self.put(3)
+        bad_id = MailJob.query.order_by(MailJob.id).first().id
+        message = MailQueue._message
+
+        def fake_message(row):
+            if row.id == bad_id:
+                raise ValueError('bad template')
+            return message(row)
+
+        with mock.patch.object(MailQueue, '_message', side_effect=fake_message):
+            with mail.record_messages() as outbox:
+                self.assertEqual(self.queue.process(), 2)
+        self.assertEqual(len(outbox), 2)
+        job = MailJob.query.one()
+        self.assertEqual((job.id, job.status, job.attempts, job.claim),
+                         (bad_id, 'pending', 1, None))
+        self.assertEqual(job.last_error, 'bad template')
+
+    # 测试批量邮件模板只渲染一次，每个收件人替换各自的字段（html中转义）
+    def test_send_bulk_email(self):
+        users = [User(email='john@example.com', username='john'),
+                 User(email='tom@example.com', username='<tom>')]
+        ctx = {user.email: {'user': user} for user in users}
+        with mock.patch('app.email.render_template',
+                        wraps=render_template) as render, \
+                mock.patch.object(mail, 'connect', wraps=mail.connect) as connect, \
+                mail.record_messages() as outbox:
+            count = send_bulk_email([user.email for user in users], '公告',
+                                    'mail/announcement', ctx, content='a & b')
+        self.assertEqual(count, 2)
+        self.assertEqual(render.call_count, 2)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(outbox[0].recipients, ['john@example.com'])
+        self.assertIn('尊敬的 john,', outbox[0].body)
+        self.assertIn('尊敬的 <tom>,', outbox[1].body)
+        self.assertIn('尊敬的 &lt;tom&gt;,', outbox[1].html)
+        self.assertIn('a &amp; b', outbox[1].html)
+
+    # 测试批量发送中途连接断开时抛出BulkEmailError，记录已发送数和未发送的收件人
+    def test_send_bulk_email_interrupted(self):
+        recipients = ['u0@example.com', 'u1@example.com', 'u2@example.com']
+        ctx = {to: {'user': User(email=to, username=to)} for to in recipients}
+        error = smtplib.SMTPServerDisconnected('closed')
+        with self.fail_for('u1@example.com', error), \
+                mail.record_messages() as outbox:
+            with self.assertRaises(BulkEmailError) as cm:
+                send_bulk_email(recipients, '公告', 'mail/announcement', ctx,
+                                content='c')
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual((cm.exception.sent, cm.exception.recipient),
+                         (1, 'u1@example.com'))
+        self.assertEqual(cm.exception.remaining, recipients[1:])
+
+    # 测试收件人的模板变量不同时在发送前抛出ValueError
+    def test_send_bulk_email_fields_mismatch(self):
+        ctx = {'u0@example.com': {'user': User(username='u0')},
+               'u1@example.com': {}}
+        with mock.patch.object(mail, 'connect') as connect:
+            with self.assertRaises(ValueError):
+                send_bulk_email(list(ctx), '公告', 'mail/announcement', ctx,
+                                content='c')
+        connect.assert_not_called()
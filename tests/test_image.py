@@ -0,0 +1,185 @@
+import glob
+import hashlib
+import os
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from unittest import mock
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+from app import create_app, db, image
+from app.image import save_avatar, write_avatar, avatar_hash, gc_avatars, \
+    immutable_avatar_headers, avatar_url, scale_square, AvatarError
+from app.main.errors import reject_large_request
+from app.models import User, Role
+
+
+class AvatarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config['AVATAR_DEST'] = self.tmp.name
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def make_image(size, format):
+        buf = BytesIO()
+        Image.new('RGB', size, (200, 120, 40)).save(buf, format)
+        return buf.getvalue()
+
+    # 生成头像，返回{尺寸名称: 头像路径}和头像hash
+    @staticmethod
+    def write(data):
+        digest = avatar_hash(hashlib.sha1(data).hexdigest())
+        return write_avatar(BytesIO(data), digest), digest
+
+    # 测试生成各尺寸的JPEG和WebP头像，文件名为内容hash
+    def test_write_avatar(self):
+        paths, digest = self.write(self.make_image((1600, 1000), 'JPEG'))
+        self.assertEqual(paths['big'], '{}/{}-big.jpg'.format(digest[:2], digest))
+        for name, size in self.app.config['AVATAR_SIZES'].items():
+            for ext in ('jpg', 'webp'):
+                path = os.path.join(self.tmp.name, digest[:2],
+                                    '{}-{}.{}'.format(digest, name, ext))
+                with Image.open(path) as im:
+                    self.assertEqual(im.size, (size, size))
+        # 没有残留的临时文件
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, digest[:2]))), 4)
+
+    # 测试没有Image.reduce()的Pillow版本（7.0之前）也能缩放
+    def test_scale_without_reduce(self):
+        im = Image.new('RGB', (1000, 1000), (200, 120, 40))
+        with mock.patch.object(Image.Image, 'reduce', None):
+            scaled = scale_square(im, 128)
+        self.assertEqual(scaled.size, (128, 128))
+        self.assertEqual(scaled.getpixel((64, 64)), (200, 120, 40))
+
+    # 测试解码、编码图片时不持有文件锁，多个头像可以并行处理
+    def test_encode_without_lock(self):
+        scale = image.scale_square
+
+        def check_unlocked(im, size):
+            self.assertFalse(image._files_lock.locked())
+            return scale(im, size)
+
+        with mock.patch('app.image.scale_square', side_effect=check_unlocked) as m:
+            self.write(self.make_image((200, 200), 'PNG'))
+        self.assertEqual(m.call_count, len(self.app.config['AVATAR_SIZES']))
+
+    # 测试上传头像后更新用户的头像路径，相同的图片共用文件，旧头像不再使用时被删除
+    def test_save_avatar(self):
+        self.app.config['AVATAR_GC_GRACE'] = 0
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='tom@example.com', username='tom', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        first = self.make_image((300, 500), 'PNG')
+        second = self.make_image((64, 64), 'GIF')
+        for u in (u1, u2):
+            save_avatar(u, FileStorage(BytesIO(first), filename='me.png'))
+        db.session.expire_all()
+        self.assertEqual(u1.b_avatar, u2.b_avatar)
+        first_big = os.path.join(self.tmp.name, u1.b_avatar)
+        self.assertTrue(os.path.exists(first_big))
+        save_avatar(u1, FileStorage(BytesIO(second), filename='me.gif'))
+        # tom仍在使用原来的头像
+        self.assertTrue(os.path.exists(first_big))
+        save_avatar(u2, FileStorage(BytesIO(second), filename='me.gif'))
+        self.assertFalse(os.path.exists(first_big))
+        # 没有残留的上传临时文件
+        self.assertFalse([f for f in os.listdir(self.tmp.name)
+                          if f.endswith('.upload')])
+
+    # 测试拒绝扩展名、文件头不符，文件过大和像素数过多的上传
+    def test_reject_upload(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        png = self.make_image((300, 200), 'PNG')
+        self.app.config['AVATAR_MAX_PIXELS'] = 300 * 200 - 1
+        uploads = [(b'', 'me.txt'), (b'not an image', 'me.jpg'),
+                   (b'\xff\xd8\xff' + b'x' * 100, 'me.jpg'),
+                   (png, 'me.png'), (b'GIF89a' + b'x' * 5000, 'me.gif')]
+        self.app.config['AVATAR_MAX_SIZE'] = 4096
+        for data, filename in uploads:
+            with self.assertRaises(AvatarError):
+                save_avatar(u, FileStorage(BytesIO(data), filename=filename))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(u.b_avatar, 'default/big.jpg')
+
+    # 测试提交后台任务失败时删除上传的临时文件
+    def test_submit_failure_removes_upload(self):
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['AVATAR_WORKERS'] = 2
+        executor = mock.Mock()
+        executor.submit.side_effect = RuntimeError('shutdown')
+        with mock.patch('app.image._get_executor', return_value=executor):
+            with self.assertRaises(RuntimeError):
+                save_avatar(u, FileStorage(BytesIO(self.make_image((64, 64), 'PNG')),
+                                           filename='me.png'))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    # 测试请求体超过MAX_CONTENT_LENGTH时返回413，检查先于载入用户进行
+    def test_request_too_large(self):
+        self.assertIs(self.app.before_request_funcs[None][0],
+                      reject_large_request)
+        self.app.config['MAX_CONTENT_LENGTH'] = 1024
+        response = self.app.test_client().post(
+            '/editprofile', data={'avatar': (BytesIO(b'x' * 2048), 'me.jpg')})
+        self.assertEqual(response.status_code, 413)
+
+    # 测试清理不再使用的头像文件，最近写入的文件（可能尚未提交）不删除
+    def test_gc_avatars(self):
+        paths, _ = self.write(self.make_image((100, 100), 'PNG'))
+        u = User(email='john@example.com', username='john',
+                 b_avatar=paths['big'], s_avatar=paths['small'])
+        db.session.add(u)
+        db.session.commit()
+        _, digest = self.write(self.make_image((90, 90), 'PNG'))
+        self.assertEqual(gc_avatars(), 0)
+        old = time.time() - self.app.config['AVATAR_GC_GRACE'] - 1
+        for f in glob.glob(os.path.join(self.tmp.name, '*', '*')):
+            os.utime(f, (old, old))
+        # 重新使用已有的文件时更新修改时间
+        self.write(self.make_image((90, 90), 'PNG'))
+        self.assertEqual(gc_avatars(), 0)
+        for f in glob.glob(os.path.join(self.tmp.name, '*', digest + '-*')):
+            os.utime(f, (old, old))
+        self.assertEqual(gc_avatars(), 4)
+        self.assertEqual(gc_avatars(), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, paths['small'])))
+
+    # 测试内容hash命名的头像设置长期缓存
+    def test_immutable_headers(self):
+        path = '/static/avatar/ab/{}-small.jpg'.format('ab' * 20)
+        for url, immutable in ((path, True), ('/static/avatar/default/small.jpg', False)):
+            with self.app.test_request_context(url):
+                self.app.preprocess_request()
+                response = immutable_avatar_headers(self.app.response_class('x'))
+                self.assertEqual('immutable' in response.headers.get(
+                    'Cache-Control', ''), immutable)
+
+    # 测试小头像内嵌为data URI，超过阈值或关闭时使用静态文件地址
+    def test_avatar_url(self):
+        paths, _ = self.write(self.make_image((100, 100), 'PNG'))
+        with self.app.test_request_context('/'):
+            self.assertTrue(avatar_url(paths['small']).startswith('data:image/jpeg;base64,'))
+            self.assertTrue(avatar_url(paths['big']).startswith('data:image/jpeg;base64,'))
+            self.app.config['AVATAR_INLINE_MAX_SIZE'] = 100
+            self.assertEqual(avatar_url(paths['small']),
+                             '/static/avatar/' + paths['small'])
+            self.app.config['AVATAR_INLINE_MAX_SIZE'] = 0
+            self.assertEqual(avatar_url('default/small.jpg'),
+                             '/static/avatar/default/small.jpg')
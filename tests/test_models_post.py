@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment, PostLike, View
+from app.buffer import ViewBuffer
+from app.render import render_cache, make_abstract
+from app.rerender import rerender_model, rerender_models, load_checkpoint
+
+
+class PostModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # 测试点赞、取消点赞会同步更新文章点赞数
+    def test_like_counts(self):
+        u = User(email='john@example.com', password='cat')
+        p = Post(title='title', body='body', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.assertEqual(p.likes_count, 0)
+        self.assertTrue(u.post_like(p.id))
+        self.assertFalse(u.post_like(p.id))
+        db.session.commit()
+        self.assertEqual(p.likes_count, 1)
+        self.assertEqual(p.likes.count(), 1)
+        self.assertTrue(u.post_unlike(p.id))
+        self.assertFalse(u.post_unlike(p.id))
+        db.session.commit()
+        self.assertEqual(p.likes_count, 0)
+
+    # 测试重新统计计数会修正不一致的文章
+    def test_update_counts(self):
+        u = User(email='john@example.com', password='cat')
+        p1 = Post(title='title', body='body', author=u)
+        p2 = Post(title='title', body='body', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        db.session.add_all([Comment(body='c', post=p1, author=u),
+                            Comment(body='c', post=p1, author=u),
+                            PostLike(post_id=p1.id, liker_id=u.id)])
+        db.session.commit()
+        self.assertEqual(Post.update_counts(), 1)
+        self.assertEqual(p1.comments_count, 2)
+        self.assertEqual(p1.likes_count, 1)
+        self.assertEqual(p2.comments_count, 0)
+        self.assertEqual(Post.update_counts(), 0)
+
+    # 测试阅读记录缓冲区去重后批量写入阅读记录和阅读数
+    def test_view_buffer(self):
+        buffer = ViewBuffer()
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='tom@example.com', password='dog')
+        p = Post(title='title', body='body', author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        buffer.add(p.id, u1.id)
+        buffer.add(p.id, u1.id)
+        buffer.add(p.id, u2.id)
+        self.assertEqual(buffer.flush(), 2)
+        buffer.add(p.id, u1.id)
+        self.assertEqual(buffer.flush(), 0)
+        db.session.expire_all()
+        self.assertEqual(p.views_count, 2)
+        self.assertEqual(View.query.filter_by(post_id=p.id).count(), 2)
+        self.assertTrue(u1.is_viewed(p.id))
+
+    # 测试没有后台线程时阅读记录在请求结束时写入
+    def test_views_flushed_after_request(self):
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True)
+        p = Post(title='title', body='body', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = str(u.id)
+            session['_fresh'] = True
+        client.get('/post/{}'.format(p.id))
+        self.assertEqual(View.query.filter_by(post_id=p.id).count(), 1)
+
+    # 测试文章主体没有变化时不重新渲染
+    def test_body_not_rerendered(self):
+        p = Post(title='title', body='**hello**')
+        self.assertEqual(p.body_html, '<p><strong>hello</strong></p>')
+        p.body_html = 'stale'
+        p.body = '**hello**'
+        self.assertEqual(p.body_html, 'stale')
+        p.body = '*hello*'
+        self.assertEqual(p.body_html, '<p><em>hello</em></p>')
+
+    # 测试修改文章主体时同时生成摘要
+    def test_abstract(self):
+        p = Post(title='title', body='**hello** & world')
+        self.assertEqual(p.abstract, 'hello & world')
+        p.body = '# title\n\n' + '蜜蜂' * 100
+        self.assertEqual(p.abstract, 'title\n' + '蜜蜂' * 27 + '...')
+        self.assertEqual(make_abstract('<p>' + 'a' * 5000 + '</p>' * 1000, 60),
+                         'a' * 60 + '...')
+
+    # 测试相同内容的渲染结果取自缓存
+    def test_render_cache(self):
+        render_cache.clear()
+        hits = render_cache.hits
+        Comment(body='**same body**')
+        c = Comment(body='**same body**')
+        self.assertEqual(render_cache.hits, hits + 1)
+        self.assertEqual(c.body_html, '<strong>same body</strong>')
+
+    # 测试批量重新渲染能修正body_html和摘要，并能从断点继续（已完成的表不再处理）
+    def test_rerender(self):
+        posts = [Post(title=str(i), body='**post {}**'.format(i))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        Post.query.update({Post.body_html: 'stale', Post.abstract: 'stale'})
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'checkpoint.json')
+            with open(path, 'w') as f:
+                json.dump({'posts': posts[1].id}, f)
+            count = rerender_model(Post, chunk_size=2, workers=1,
+                                   checkpoint_path=path, echo=lambda s: None)
+            self.assertEqual(count, 3)
+            self.assertEqual(load_checkpoint(path), {'posts': posts[4].id})
+            # 文章已处理完，继续运行时只处理评论，全部完成后删除断点文件
+            db.session.add(Comment(body='*comment*'))
+            db.session.commit()
+            counts = rerender_models((Post, Comment), chunk_size=2, workers=1,
+                                     checkpoint_path=path, echo=lambda s: None)
+            self.assertEqual(counts, [('posts', 0), ('comments', 1)])
+            self.assertFalse(os.path.exists(path))
+        db.session.expire_all()
+        self.assertEqual(posts[1].body_html, 'stale')
+        self.assertEqual(posts[4].body_html, '<p><strong>post 4</strong></p>')
+        self.assertEqual(posts[4].abstract, 'post 4')
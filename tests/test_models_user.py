@@ -1,7 +1,15 @@
+import os
+import tempfile
+import threading
 import unittest
 import time
+from flask import g
+from sqlalchemy import event
+from datetime import datetime, timedelta
 from app import create_app, db
-from app.models import User, Role, Permission, AnonymousUser
+from app.models import User, Role, Permission, AnonymousUser, Post, Timeline, \
+    load_user
+from app.buffer import LastLoginBuffer
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -213,4 +221,203 @@ class UserModelTestCase(unittest.TestCase):
         self.assertFalse(u.can(Permission.COMMENT))
         self.assertFalse(u.can(Permission.WRITE))
         self.assertFalse(u.can(Permission.MODERATE))
-        self.assertFalse(u.can(Permission.ADMIN))
\ No newline at end of file
+        self.assertFalse(u.can(Permission.ADMIN))
+
+    # 测试载入用户后检查权限不访问数据库，权限表重新读入后才生效
+    def test_permission_table(self):
+        Role.insert_roles()
+        u = User(email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user = User.query.get(u.id)
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertTrue(user.can(Permission.FOLLOW))
+            self.assertFalse(user.is_administrator())
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+        role = Role.query.filter_by(name='User').first()
+        role.remove_permission(Permission.FOLLOW)
+        db.session.commit()
+        self.assertTrue(user.can(Permission.FOLLOW))
+        Role.load_table()
+        self.assertFalse(user.can(Permission.FOLLOW))
+        with self.assertRaises(TypeError):
+            Role.table()['permissions'][role.id] = 0
+
+    # 测试用户缓存命中时不查询数据库，修改用户后缓存失效
+    def test_user_cache(self):
+        Role.insert_roles()
+        u = User(email='john@example.com', username='john', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            db.session.remove()
+            load_user(str(user_id))
+            self.assertEqual(len(statements), 1)
+            db.session.remove()
+            user = load_user(str(user_id))
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(user.username, 'john')
+            self.assertTrue(user.verify_password('cat'))
+            self.assertTrue(user.can(Permission.WRITE))
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        user.name = 'John'
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(load_user(str(user_id)).name, 'John')
+
+    # 测试上次登陆时间在合并窗口内不重复记录，并能批量写入数据库
+    def test_last_login_buffer(self):
+        buffer = LastLoginBuffer()
+        last_login = datetime.utcnow() - timedelta(days=1)
+        u1 = User(email='john@example.com', password='cat', last_login=last_login)
+        u2 = User(email='tom@example.com', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertTrue(buffer.touch(u1))
+        self.assertFalse(buffer.touch(u1))
+        self.assertFalse(buffer.touch(u2))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.flush(), 0)
+        db.session.expire_all()
+        self.assertTrue(u1.last_login > last_login)
+
+
+    # 测试一次查询得出多个用户的关注状态，同一请求内不重复查询
+    def test_following_ids(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='tom@example.com', password='dog')
+        u3 = User(email='susan@example.com', password='fish')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        u1, u2, u3 = User.query.order_by(User.id).all()
+        ids = [u2.id, u3.id]
+        # 模拟新的请求
+        g.pop('following_state', None)
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(u1.following_ids(ids), {u2.id})
+            self.assertTrue(u1.is_following(u2))
+            self.assertFalse(u1.is_following(u3))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u1.is_followed_by(u2))
+        u1.unfollow(u2)
+        self.assertEqual(u1.following_ids(ids), set())
+        self.assertEqual(AnonymousUser().following_ids(ids), set())
+
+    # 测试关注动态：关注时加入已有文章，新文章写入粉丝动态，取消关注时删除
+    def test_timeline(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='tom@example.com', password='dog')
+        p1 = Post(title='old', body='body', author=u2)
+        db.session.add_all([u1, u2, p1])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p1])
+        p2 = Post(title='new', body='body', author=u2)
+        db.session.add(p2)
+        db.session.flush()
+        Timeline.fan_out(p2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 2)
+        self.assertEqual(u2.followed_posts.count(), 0)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 0)
+        u1.follow(u2)
+        db.session.commit()
+        Timeline.query.delete()
+        self.assertEqual(Timeline.rebuild(), 2)
+        self.assertEqual(u1.followed_posts.count(), 2)
+
+
+# 粉丝数、关注数在并发关注、取消关注时的一致性
+# 使用临时数据库文件，各线程有各自的数据库连接和会话
+class FollowCountTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(self.tmp.name, 'test.db')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        users = [User(email='u{}@example.com'.format(i), password='cat')
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = [u.id for u in users]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    # 多个线程同时执行关注或取消关注，pairs为(关注者id, 被关注者id)
+    def run_concurrently(self, action, pairs):
+        barrier = threading.Barrier(len(pairs))
+        errors = []
+
+        def run(follower_id, followed_id):
+            with self.app.app_context():
+                try:
+                    follower = User.query.get(follower_id)
+                    followed = User.query.get(followed_id)
+                    barrier.wait()
+                    getattr(follower, action)(followed)
+                    db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=run, args=pair) for pair in pairs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+
+    # 测试并发关注、重复关注、取消关注后计数与关注表一致
+    def test_concurrent_follow(self):
+        u0, u1, u2, u3 = self.ids
+        self.run_concurrently('follow', [(u1, u0), (u1, u0), (u2, u0), (u3, u0)])
+        self.assertEqual(User.query.get(u0).followers_count, 3)
+        self.assertEqual(User.query.get(u1).following_count, 1)
+        self.run_concurrently('unfollow', [(u1, u0), (u1, u0), (u2, u0)])
+        self.assertEqual(User.query.get(u0).followers_count, 1)
+        self.assertEqual(User.query.get(u1).following_count, 0)
+        self.assertEqual(User.query.get(u3).following_count, 1)
+
+    # 测试按关注表修正计数
+    def test_update_follow_counts(self):
+        u0, u1, u2, u3 = self.ids
+        User.query.get(u1).follow(User.query.get(u0))
+        db.session.commit()
+        User.query.update({User.followers_count: 5})
+        db.session.commit()
+        self.assertEqual(User.update_follow_counts(), 4)
+        self.assertEqual(User.query.get(u0).followers_count, 1)
+        self.assertEqual(User.update_follow_counts(), 0)
@@ -0,0 +1,84 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.pagination import KeysetPagination
+
+
+class KeysetPaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email='john@example.com', password='cat')
+        # 阅读数有重复，检验(阅读数, id)组合排序
+        self.posts = [Post(title=str(i), body='body', author=u,
+                           views_count=i // 2) for i in range(7)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def paginate(self, **kwargs):
+        return KeysetPagination(Post.query, [Post.views_count, Post.id],
+                                per_page=3, **kwargs)
+
+    # 测试向后翻页能按顺序不重不漏地取出所有文章
+    def test_next_pages(self):
+        expected = sorted(self.posts, key=lambda p: (p.views_count, p.id),
+                          reverse=True)
+        items = []
+        page = self.paginate()
+        self.assertFalse(page.has_prev)
+        while True:
+            items.extend(page.items)
+            if not page.has_next:
+                break
+            page = self.paginate(after=page.next_cursor)
+        self.assertEqual(items, expected)
+
+    # 测试向前翻页能回到上一页
+    def test_prev_page(self):
+        first = self.paginate()
+        second = self.paginate(after=first.next_cursor)
+        self.assertTrue(second.has_prev)
+        back = self.paginate(before=second.prev_cursor)
+        self.assertEqual(back.items, first.items)
+        self.assertFalse(back.has_prev)
+
+    # 测试无效游标从第一页开始
+    def test_invalid_cursor(self):
+        self.assertEqual(self.paginate(after='abc').items,
+                         self.paginate().items)
+
+    # 测试升序分页时显示最后一页
+    def test_last_page_ascending(self):
+        u = User.query.first()
+        comments = [Comment(body=str(i), author=u, post=self.posts[0])
+                    for i in range(5)]
+        db.session.add_all(comments)
+        db.session.commit()
+        page = KeysetPagination(Comment.query, [Comment.timestamp, Comment.id],
+                                per_page=3, desc=False, last=True)
+        self.assertEqual(page.items, comments[2:])
+        self.assertTrue(page.has_prev)
+        self.assertFalse(page.has_next)
+        prev = KeysetPagination(Comment.query, [Comment.timestamp, Comment.id],
+                                per_page=3, desc=False, before=page.prev_cursor)
+        self.assertEqual(prev.items, comments[:2])
+        self.assertTrue(prev.has_next)
+
+    # 测试总数在缓存期内不重复统计，缓存保存在各自的应用中
+    def test_cached_total(self):
+        self.assertEqual(self.paginate(count_key='test').total, 7)
+        db.session.add(Post(title='new', body='body'))
+        db.session.commit()
+        self.assertEqual(self.paginate(count_key='test').total, 7)
+        self.assertIsNone(self.paginate().total)
+        # 每个应用的总数缓存互相独立
+        with create_app('testing').app_context():
+            self.assertEqual(self.paginate(count_key='test').total, 8)
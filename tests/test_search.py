@@ -0,0 +1,95 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post
+from app.search import search_index, tokenize, highlight
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john',
+                         password='cat')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, q):
+        return search_index().search(q, 0, 10)
+
+    # 测试中文按二元切分，英文按单词切分并转为小写
+    def test_tokenize(self):
+        self.assertEqual(tokenize('Flask入门教程，第2版'),
+                         ['flask', '入门', '门教', '教程', '第', '2', '版'])
+        self.assertEqual(str(highlight('<b>Flask</b>入门', 'flask 入门')),
+                         '&lt;b&gt;<mark>Flask</mark>&lt;/b&gt;<mark>入门</mark>')
+
+    # 测试发表、修改、删除文章后提交事务时更新索引，回滚时不更新
+    def test_incremental_index(self):
+        p = Post(title='春天', body='北京的春天风很大', author=self.user)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(self.search('北京'), ([p.id], 1))
+        self.assertEqual(self.search('京春'), ([], 0))
+        p.body = '上海的夏天很热'
+        db.session.commit()
+        self.assertEqual(self.search('北京'), ([], 0))
+        self.assertEqual(self.search('夏天 上海'), ([p.id], 1))
+        p.title = '广州'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.search('广州'), ([], 0))
+        # 单个汉字无论在词首还是词尾都能搜到
+        p2 = Post(title='随笔', body='我喜欢读书', author=self.user)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(self.search('书'), ([p2.id], 1))
+        self.assertEqual(self.search('喜'), ([p2.id], 1))
+        db.session.delete(p2)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(self.search('上海'), ([], 0))
+
+    # 测试标题中的词排在正文中的词之前，重建索引后结果不变
+    def test_ranking_and_reindex(self):
+        p1 = Post(title='随笔', body='今天学习了Python', author=self.user)
+        p2 = Post(title='Python入门', body='变量和函数', author=self.user)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(self.search('python'), ([p2.id, p1.id], 2))
+        search_index().update({p1.id: None, p2.id: None})
+        self.assertEqual(self.search('python'), ([], 0))
+        self.assertEqual(Post.reindex(), 2)
+        self.assertEqual(self.search('python'), ([p2.id, p1.id], 2))
+
+    # 测试搜索页面高亮摘要中的搜索词
+    def test_search_page(self):
+        db.session.add(Post(title='标题', body='蜜蜂博客的搜索功能',
+                            author=self.user))
+        db.session.commit()
+        client = self.app.test_client()
+        response = client.get('/search?q=搜索')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('<mark>搜索</mark>功能', response.get_data(as_text=True))
+        response = client.get('/search?q=没有')
+        self.assertIn('没有找到相关文章', response.get_data(as_text=True))
+
+    # 测试搜索结果按页码翻页
+    def test_search_pages(self):
+        db.session.add_all([Post(title='标题{}'.format(i), body='蜜蜂',
+                                 author=self.user) for i in range(12)])
+        db.session.commit()
+        client = self.app.test_client()
+        data = client.get('/search?q=蜜蜂').get_data(as_text=True)
+        self.assertIn('第 1/2 页', data)
+        self.assertIn('page=2', data)
+        data = client.get('/search?q=蜜蜂&page=2').get_data(as_text=True)
+        self.assertEqual(data.count('class="post-list-abstract"'), 2)
+        self.assertIn('page=1', data)